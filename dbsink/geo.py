@@ -0,0 +1,122 @@
+#!python
+# coding=utf-8
+import struct
+from collections import OrderedDict
+
+import numpy as np
+from geoalchemy2.elements import WKBElement
+
+WKB_POINT = 1
+EWKB_SRID_FLAG = 0x20000000
+
+# Little endian 2D points, without and with an SRID
+WKB_POINT_STRUCT = struct.Struct('<BIdd')
+EWKB_POINT_STRUCT = struct.Struct('<BIIdd')
+WKB_POINT_DTYPE = np.dtype([
+    ('order', 'u1'),
+    ('type',  '<u4'),
+    ('x',     '<f8'),
+    ('y',     '<f8'),
+])
+EWKB_POINT_DTYPE = np.dtype([
+    ('order', 'u1'),
+    ('type',  '<u4'),
+    ('srid',  '<u4'),
+    ('x',     '<f8'),
+    ('y',     '<f8'),
+])
+
+
+def ewkb_hex(element):
+    """ Hex encoded EWKB for a WKBElement, embedding the element's SRID so
+        it can be loaded into a column with an SRID constraint.
+    """
+    data = bytes(element.data)
+    if element.extended or element.srid is None or element.srid <= 0:
+        return data.hex()
+
+    order = '<' if data[0] == 1 else '>'
+    geomtype, = struct.unpack(f'{order}I', data[1:5])
+    header = struct.pack(f'{order}II', geomtype | EWKB_SRID_FLAG, element.srid)
+    return (data[0:1] + header + data[5:]).hex()
+
+
+def point_wkb(x, y):
+    """ WKB for a 2D point, the same bytes shapely writes for `Point(x, y)` """
+    return WKB_POINT_STRUCT.pack(1, WKB_POINT, x, y)
+
+
+def point_ewkb(x, y, srid=4326):
+    """ EWKB for a 2D point, embedding the SRID """
+    return EWKB_POINT_STRUCT.pack(1, WKB_POINT | EWKB_SRID_FLAG, srid, x, y)
+
+
+def point_element(x, y, srid=4326):
+    """ A WKBElement for a 2D point without creating a shapely geometry.
+        Equivalent to `from_shape(Point(x, y), srid=srid)`.
+    """
+    return WKBElement(point_wkb(x, y), srid=srid, extended=False)
+
+
+def _pack_points(dtype, x, y, **fields):
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    points = np.empty(x.size, dtype=dtype)
+    points['order'] = 1
+    for k, v in fields.items():
+        points[k] = v
+    points['x'] = x.ravel()
+    points['y'] = y.ravel()
+
+    data = points.tobytes()
+    size = dtype.itemsize
+    return [ data[i:i + size] for i in range(0, len(data), size) ]
+
+
+def points_wkb(x, y):
+    """ WKB for each point of arrays of x and y coordinates """
+    return _pack_points(WKB_POINT_DTYPE, x, y, type=WKB_POINT)
+
+
+def points_ewkb(x, y, srid=4326):
+    """ EWKB, embedding the SRID, for each point of arrays of x and y coordinates """
+    return _pack_points(EWKB_POINT_DTYPE, x, y, type=WKB_POINT | EWKB_SRID_FLAG, srid=srid)
+
+
+def point_elements(x, y, srid=4326):
+    """ A WKBElement for each point of arrays of x and y coordinates """
+    return [ WKBElement(data, srid=srid, extended=False) for data in points_wkb(x, y) ]
+
+
+class GeometryCache:
+    """ A bounded LRU cache of geometries that counts its hits and misses """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return f'<GeometryCache size={len(self)}/{self.maxsize} hits={self.hits} misses={self.misses}>'
+
+    def get(self, key):
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
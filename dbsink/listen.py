@@ -1,23 +1,19 @@
 #!python
 # coding=utf-8
+import time
 import logging
-import pkg_resources
-import simplejson as json
+from collections import Counter
 from datetime import datetime
 
 import pytz
 import click
 
 import sqlalchemy as sql
-from sqlalchemy.dialects.postgresql import insert
 
 from dbsink import L, ea, log_format, utils
-
-
-def get_mappings():
-    return {
-        e.name: e.resolve() for e in pkg_resources.iter_entry_points('dbsink.maps')
-    }
+from dbsink.utils import get_mappings
+from dbsink.pipeline import MapWorkers, Pipeline, map_message, map_messages
+from dbsink.writer import BatchSizer, BatchWriter, CopyWriter, StagingCopyWriter
 
 
 @click.command()
@@ -30,18 +26,32 @@ def get_mappings():
 @click.option('--consumer', type=str, default='', help="Consumer group to listen with (default: random).")
 @click.option('--offset',   type=str, default='largest', help="Kafka offset to start with (default: largest).")
 @click.option('--packing',  type=click.Choice(['json', 'avro', 'msgpack']), default='json', help="The data unpacking algorithm to use (default: json).")
-@click.option('--registry', type=str, default='http://localhost:4002', help="URL to a Schema Registry if avro packing is requested")
+@click.option('--json-engine', type=click.Choice(['simplejson', 'json', 'orjson']), default='simplejson', help="The library used to decode and encode JSON (default: simplejson).")
+@click.option('--raw-json/--no-raw-json', default=False, help="Only validate JSON messages and store their original text if the mapping supports it, like JsonMap and StringMap (default: disabled).")
+@click.option('--registry', type=str, default='http://localhost:4002', help="URL to a Schema Registry if avro packing is requested, or a local directory of <id>.avsc files or a single .avsc file to use instead.")
+@click.option('--avro-decoder', type=click.Choice(['easyavro', 'fastavro']), default='easyavro', help="Decode avro messages in the consumer (easyavro) or with cached fastavro schemas (default: easyavro). Local registries always use fastavro.")
 @click.option('--drop/--no-drop', default=False, help="Drop the table first")
 @click.option('--truncate/--no-truncate', default=False, help="Truncate the table first")
 @click.option('--logfile',  type=str, default='', help="File to log messages to (default: stdout).")
 @click.option('--listen/--no-listen', default=True, help="Whether to listen for messages.")
 @click.option('--do-inserts/--no-do-inserts', default=True, help="Whether to insert data into a database.")
-@click.option('--datafile', type=str, default='', help="File to pull messages from instead of listening for messages.")
+@click.option('--datafile', type=str, default='', help="File, directory or glob pattern of files to pull messages from instead of listening for messages. Multiple files are loaded in parallel by --workers processes.")
+@click.option('--batch-size', type=int, default=1, help="Number of rows to buffer before writing them in one transaction (default: 1).")
+@click.option('--batch-ms',   type=int, default=1000, help="Maximum time in milliseconds to buffer rows before writing them (default: 1000).")
+@click.option('--adaptive/--no-adaptive', default=False, help="Adapt the batch size and linger time to the write latency and backlog, using --batch-size and --batch-ms as the upper bounds.")
+@click.option('--min-batch-size', type=int, default=1, help="Smallest batch size when using --adaptive (default: 1).")
+@click.option('--min-batch-ms',   type=int, default=100, help="Shortest linger time in milliseconds when using --adaptive (default: 100).")
+@click.option('--load-mode',  type=click.Choice(['insert', 'copy']), default='insert', help="How batches are written to the database (default: insert).")
+@click.option('--transactional/--no-transactional', default=False, help="Only commit consumer offsets after the rows are committed to the database.")
+@click.option('--writer-threads', type=int, default=0, help="Map and write batches on background threads using this many database writer threads (default: 0, write on the consumer thread). Mappings that upsert rows use at most 1 writer thread.")
+@click.option('--queue-size', type=int, default=4, help="Maximum number of batches waiting to be mapped or written when using writer threads (default: 4).")
+@click.option('--workers', type=int, default=1, help="Number of consumer processes sharing the consumer group, restarted if they crash, or the number of datafiles loaded at once (default: 1).")
+@click.option('--map-workers', type=int, default=0, help="Map messages on a pool of this many processes (default: 0, map on the current process).")
 @click.option('-v', '--verbose', count=True, help="Control the output verbosity, use up to 3 times (-vvv)")
 # Filters
 @click.option('--start_date', type=click.DateTime(), required=False, default=None, help="Start date filter passed to each mapping class (UTC)")
 @click.option('--end_date',   type=click.DateTime(), required=False, default=None, help="End date filter passed to each mapping class (UTC)")
-def setup(brokers, topic, table, lookup, db, schema, consumer, offset, packing, registry, drop, truncate, logfile, listen, do_inserts, datafile, verbose, start_date, end_date):
+def setup(brokers, topic, table, lookup, db, schema, consumer, offset, packing, json_engine, raw_json, registry, avro_decoder, drop, truncate, logfile, listen, do_inserts, datafile, batch_size, batch_ms, adaptive, min_batch_size, min_batch_ms, load_mode, transactional, writer_threads, queue_size, workers, map_workers, verbose, start_date, end_date):
 
     if logfile:
         handler = logging.FileHandler(logfile)
@@ -56,6 +66,68 @@ def setup(brokers, topic, table, lookup, db, schema, consumer, offset, packing,
         ea.setLevel(logging.DEBUG)
         L.setLevel(logging.DEBUG)
 
+    if workers > 1 and listen is True and not datafile:
+        params = dict(click.get_current_context().params)
+
+        # Every worker joins the same consumer group so the partitions
+        # are balanced between them
+        if not params['consumer']:
+            params['consumer'] = utils.random_consumer_group(topic)
+            L.info(f'Setting consumer to {params["consumer"]}')
+
+        # Setup the table once before any of the workers start
+        setup.callback(**{
+            **params,
+            'logfile': '',
+            'listen': False,
+            'workers': 1,
+            'writer_threads': 0,
+            'map_workers': 0
+        })
+
+        params.update(drop=False, truncate=False, workers=1)
+        utils.supervise(run_worker, kwargs=params, workers=workers)
+        return
+
+    if datafile:
+        datafiles = utils.expand_datafiles(datafile)
+        if not datafiles:
+            raise click.BadParameter(f'No files found matching {datafile}', param_hint='--datafile')
+
+        if len(datafiles) > 1:
+            params = dict(click.get_current_context().params)
+
+            # Setup the table once before loading the files in parallel
+            setup.callback(**{
+                **params,
+                'datafile': '',
+                'logfile': '',
+                'listen': False,
+                'workers': 1,
+                'writer_threads': 0,
+                'map_workers': 0
+            })
+
+            params.update(drop=False, truncate=False, workers=1)
+            L.info(f'Loading {len(datafiles)} datafiles with {max(workers, 1)} processes')
+            started = time.monotonic()
+            results = utils.load_datafiles(run_worker, params, datafiles, workers=workers)
+
+            total = Counter()
+            failures = []
+            for d in datafiles:
+                if isinstance(results[d], BaseException):
+                    failures.append(d)
+                else:
+                    total.update(results[d])
+            L.info(utils.datafile_summary(f'{len(datafiles)} datafiles', total, time.monotonic() - started))
+
+            if failures:
+                raise click.ClickException(f'Could not load {len(failures)} datafiles: {", ".join(failures)}')
+            return total
+
+        datafile = datafiles[0]
+
     # If no specific table was specified, use the topic name
     if not table:
         table = topic
@@ -65,16 +137,32 @@ def setup(brokers, topic, table, lookup, db, schema, consumer, offset, packing,
     if not offset:
         offset = None
 
+    # Offsets are committed manually after each database transaction
+    kafka_conf = {}
+    if transactional is True and do_inserts is True:
+        kafka_conf['enable.auto.commit'] = False
+
     # Get consumer and unpack/pack information based on packing
-    consume_cls, consume_kw, unpack, pack = utils.get_kafka_consumer(
+    consume_cls, consume_kw, unpack, _ = utils.get_kafka_consumer(
         brokers=brokers.split(','),
         topic=topic,
         offset=offset,
         packing=packing,
         consumer=consumer,
-        registry=registry
+        registry=registry,
+        kafka_conf=kafka_conf,
+        json_engine=json_engine,
+        avro_decoder=avro_decoder
     )
 
+    # Datafile messages are decoded while they are read, not unpacked
+    if datafile:
+        unpack = None
+        packing = None
+
+    # Avro messages are decoded by us, not the consumer, with the registry
+    avro_registry = registry if packing == 'avro' and unpack is not None else None
+
     filters = {}
     if isinstance(start_date, datetime):
         filters['start_date'] = start_date.replace(tzinfo=pytz.utc)
@@ -86,6 +174,31 @@ def setup(brokers, topic, table, lookup, db, schema, consumer, offset, packing,
     mapping = mappings[lookup](topic, table=table, filters=filters)
     L.debug(f'Using mapping: {lookup}, topic: {topic}, table: {mapping.table}, filters: {len(filters)}')
 
+    # Validate JSON messages and pass their text through to the mapping
+    # instead of decoding them into python objects
+    raw_json = raw_json is True and packing == 'json' and mapping.raw_json is True
+    if raw_json is True:
+        unpack, _ = utils.get_packing_funcs(packing, json_engine=json_engine, raw_json=True)
+
+    # Mapping on a pool requires the pipeline
+    if map_workers > 0:
+        writer_threads = max(writer_threads, 1)
+
+    # Batches written concurrently commit in any order, so an older batch
+    # could overwrite a newer upsert of the same key (or deadlock with it)
+    if writer_threads > 1 and mapping.upsert_constraint_name is not None:
+        L.warning(f'{lookup} upserts rows, using 1 writer thread instead of {writer_threads}')
+        writer_threads = 1
+
+    # Adapt the batch size and linger time, bounded by the configured values
+    sizer = None
+    if adaptive is True:
+        sizer = BatchSizer(min_batch_size, batch_size, min_batch_ms, batch_ms)
+
+    # Decodes JSON datafiles and encodes JSONB columns
+    json_loads, json_dumps = utils.get_json_funcs(json_engine)
+
+    writer = None
     if do_inserts is True:
         """ Database connection and setup
         """
@@ -97,6 +210,8 @@ def setup(brokers, topic, table, lookup, db, schema, consumer, offset, packing,
             pool_pre_ping=True,
             client_encoding='utf8',
             use_native_hstore=True,
+            executemany_mode='values',
+            json_serializer=json_dumps,
             echo=verbose >= 2
         )
         # Create schema
@@ -134,56 +249,121 @@ def setup(brokers, topic, table, lookup, db, schema, consumer, offset, packing,
             )
         meta.create_all(tables=[sqltable])
 
+        writer_cls = BatchWriter
+        writer_kw = {}
+        if load_mode == 'copy':
+            writer_kw['json_serializer'] = json_dumps
+            if mapping.upsert_constraint_name is None:
+                writer_cls = CopyWriter
+            else:
+                writer_cls = StagingCopyWriter
+
+        writer = writer_cls(
+            engine,
+            sqltable,
+            mapping,
+            batch_size=batch_size,
+            batch_ms=batch_ms,
+            sizer=sizer if writer_threads == 0 else None,
+            **writer_kw
+        )
+
+    # Number of rows mapped and messages filtered out or failed
+    counts = Counter()
+
+    if map_workers > 0:
+        map_batch = MapWorkers(map_workers, lookup, topic, table, filters, packing, json_engine=json_engine, raw_json=raw_json, registry=avro_registry)
+    else:
+        def map_batch(messages):
+            return map_messages(mapping, messages, unpack=unpack, packing=packing, counts=counts)
+
+    # Map and write on background threads
+    pipeline = None
+    if writer_threads > 0:
+        pipeline = Pipeline(
+            map_batch,
+            writer,
+            batch_size=batch_size,
+            batch_ms=batch_ms,
+            writer_threads=writer_threads,
+            queue_size=queue_size,
+            sizer=sizer
+        )
+
+    # Commits offsets once the messages received have been written
+    committer = None
+
     def on_recieve(k, v):
-        if v is not None and unpack:
-            try:
-                v = unpack(v)
-            except BaseException:
-                L.error(f'Error unpacking message using {packing}: {v}')
-                return
+        if committer is not None:
+            committer.received()
 
-        # Custom conversion function for the table
-        try:
-            newkey, newvalues = mapping.message_to_values(k, v)
-        except utils.MessageFiltered as e:
-            L.debug(e)
-            return
-        except BaseException as e:
-            L.error(f'Skipping {v}, message could not be converted to a row - {repr(e)}')
+        if pipeline is not None:
+            pipeline.put(k, v)
             return
 
-        if do_inserts:
-            # I wonder if we can just do set_=v? Other seem to extract the
-            # exact columns to update but this method is currently working...
-            # https://gist.github.com/bhtucker/c40578a2fb3ca50b324e42ef9dce58e1
-            insert_cmd = insert(sqltable).values(newvalues)
-            if mapping.upsert_constraint_name is not None:
-                upsert_cmd = insert_cmd.on_conflict_do_update(
-                    constraint=mapping.upsert_constraint_name,
-                    set_=newvalues
-                )
-                res = engine.execute(upsert_cmd)
-                mode = 'inserted/updated'
-            else:
-                res = engine.execute(insert_cmd)
-                mode = 'inserted'
-            res.close()
-            L.debug(f'{mode} row {res.inserted_primary_key}')
+        mapped = map_message(mapping, k, v, unpack=unpack, packing=packing, counts=counts)
+        if mapped is not None and writer is not None:
+            writer.add(*mapped)
+
+    def on_recieve_timeout():
+        if pipeline is not None:
+            pipeline.tick()
+        elif writer is not None:
+            writer.tick()
+
+    def finish():
+        try:
+            if pipeline is not None:
+                pipeline.close()
+            elif writer is not None:
+                writer.flush()
+        finally:
+            if isinstance(map_batch, MapWorkers):
+                map_batch.close()
+                counts.update(map_batch.counts)
 
     if datafile:
-        with open(datafile) as f:
-            messages = json.load(f)
-            for m in messages:
-                on_recieve(None, pack(m))
+        # Messages are streamed from the file already decoded
+        started = time.monotonic()
+        try:
+            for m in utils.iter_datafile(datafile, loads=json_loads):
+                on_recieve(None, m)
+        finally:
+            finish()
+        L.info(utils.datafile_summary(datafile, counts, time.monotonic() - started))
+        return counts
     elif listen is True:
+        # Poll often enough to flush rows that have lingered too long
+        timeout = 10
+        if sizer is not None:
+            timeout = min(timeout, sizer.min_ms / 1000)
+        elif batch_size > 1 and batch_ms > 0:
+            timeout = min(timeout, batch_ms / 1000)
+
         c = consume_cls(**consume_kw)
-        c.consume(
-            on_recieve=on_recieve,
-            initial_wait=1,
-            timeout=10,
-            cleanup_every=100,
-            loop=True
-        )
+        if transactional is True and writer is not None:
+            if pipeline is not None:
+                pipeline.checkpoint = lambda: utils.consumer_positions(c)
+                pipeline.on_commit = lambda offsets: utils.commit_offsets(c, offsets)
+            else:
+                committer = utils.OffsetCommitter(c)
+                writer.on_commit = committer
+
+        try:
+            c.consume(
+                on_recieve=on_recieve,
+                on_recieve_timeout=on_recieve_timeout,
+                initial_wait=1,
+                timeout=timeout,
+                cleanup_every=100,
+                loop=True
+            )
+        finally:
+            finish()
+
+
+def run_worker(**params):
+    return setup.callback(**params)
 
 
 def run():
@@ -1,6 +1,8 @@
 #!python
 # coding=utf-8
+import math
 import simplejson as json
+from decimal import Decimal
 from datetime import datetime
 
 import pytz
@@ -10,20 +12,116 @@ from sqlalchemy.dialects.postgresql import JSONB
 from dbsink import L
 
 
+def _sanitize_key(key):
+    if isinstance(key, str):
+        return str.__str__(key)
+    elif key is True:
+        return 'true'
+    elif key is False:
+        return 'false'
+    elif key is None:
+        return 'null'
+    elif isinstance(key, int):
+        return int.__repr__(key)
+    elif isinstance(key, float):
+        return float.__repr__(key) if math.isfinite(key) else 'null'
+    elif isinstance(key, bytes):
+        return key.decode('utf-8')
+    raise TypeError(f'keys must be str, int, float, bool or None, not {type(key).__name__}')
+
+
+def _sanitize_other(value):
+    # Subclasses and the other types simplejson knows how to serialize
+    if isinstance(value, str):
+        return str.__str__(value)
+    elif isinstance(value, int):
+        return int(value)
+    elif isinstance(value, (float, Decimal)):
+        value = float(value)
+        return value if math.isfinite(value) else None
+    elif isinstance(value, bytes):
+        return value.decode('utf-8')
+    elif isinstance(value, dict):
+        return { _sanitize_key(k): sanitize(v) for k, v in value.items() }
+    elif isinstance(value, tuple) and hasattr(value, '_asdict'):
+        return sanitize(value._asdict())
+    elif isinstance(value, (list, tuple)):
+        return [ sanitize(v) for v in value ]
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def sanitize(value):
+    """ Copy a decoded JSON structure, replacing Infinity and NaN values with
+        None in a single pass. The result is the same as a `dumps(ignore_nan=True)`
+        and `loads` round trip: tuples become lists and keys become strings.
+        Raises a TypeError if something can not be represented as JSON.
+    """
+    t = type(value)
+    if t is str or t is int or t is bool or value is None:
+        return value
+    elif t is float:
+        return value if math.isfinite(value) else None
+    elif t is dict:
+        return { _sanitize_key(k): sanitize(v) for k, v in value.items() }
+    elif t is list:
+        return [ sanitize(v) for v in value ]
+    return _sanitize_other(value)
+
+
 def payload_parse(payload):
     # Make sure we have valid JSON and remove any
     # Infinity and NaN values in the process
     try:
-        return json.loads(json.dumps(payload, ignore_nan=True))
+        return sanitize(payload)
+    except BaseException as e:
+        raise ValueError(f'Could not parse message as valid JSON - {repr(e)}')
+
+
+class RawJson(str):
+    """ JSON text that has already been validated and had any Infinity and
+        NaN values replaced with null. JSON serializers write it out as-is.
+    """
+    pass
+
+
+def raw_json_parse(payload, loads=json.loads):
+    """ Validate JSON text (or UTF-8 bytes) with a single decoding pass and
+        return the original text as RawJson. Text containing Infinity or NaN
+        values is re-encoded with null in their place. `loads` must accept a
+        `parse_constant` argument. Raises a ValueError if the text is invalid.
+    """
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        payload = bytes(payload)
+
+    scrubbed = []
+
+    def parse_constant(name):
+        scrubbed.append(name)
+        return None
+
+    try:
+        value = loads(payload, parse_constant=parse_constant)
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8')
     except BaseException as e:
         raise ValueError(f'Could not parse message as valid JSON - {repr(e)}')
 
+    if scrubbed:
+        return RawJson(json.dumps(value))
+    return RawJson(payload)
+
 
 class BaseMap:
+
+    # Whether `message_to_values` accepts RawJson values so JSON messages can
+    # be validated without decoding them into python objects
+    raw_json = False
+
     def __init__(self, topic, **kwargs):
         self.topic = topic
         self.table = kwargs.get('table', topic).replace('.', '-')
         self.filters = kwargs.get('filters', {})
+        self._schema_views = None
 
     @property
     def upsert_constraint_name(self):
@@ -62,13 +160,46 @@ class BaseMap:
         """
         raise NotImplementedError
 
+    def _describe_schema(self):
+        # `schema` returns new objects on every call (a column can only belong
+        # to one table) so it is built once into a detached table to describe it
+        table = sql.Table(self.table, sql.MetaData(), *self.schema)
+
+        upsert_columns = ()
+        for c in table.constraints:
+            if self.upsert_constraint_name is None:
+                break
+            if isinstance(c, sql.UniqueConstraint) and c.name == self.upsert_constraint_name:
+                upsert_columns = tuple( col.name for col in c.columns )
+
+        self._schema_views = {
+            'column_names': frozenset(table.columns.keys()),
+            'column_types': { c.name: c.type for c in table.columns },
+            'upsert_columns': upsert_columns,
+        }
+        return self._schema_views
+
+    @property
+    def column_names(self):
+        """ The (cached) set of column names in the schema """
+        return (self._schema_views or self._describe_schema())['column_names']
+
+    @property
+    def column_types(self):
+        """ The (cached) SQLAlchemy type of each column in the schema """
+        return (self._schema_views or self._describe_schema())['column_types']
+
+    @property
+    def upsert_columns(self):
+        """ The (cached) columns of the unique constraint used to upsert rows """
+        return (self._schema_views or self._describe_schema())['upsert_columns']
+
     def match_columns(self, inserts):
         """ Throws away insert data that does not match a defined
             column name.
         """
-        # Get column names
-        column_names = [ s.name for s in self.schema if isinstance(s, sql.Column) ]
         # Throw away keys that are not column names
+        column_names = self.column_names
         matched_inserts = { k: v for k, v in inserts.items() if k in column_names }
 
         if inserts.keys() != matched_inserts.keys():
@@ -80,9 +211,27 @@ class BaseMap:
     def message_to_values(self, key, value):
         raise NotImplementedError
 
+    def messages_to_rows(self, batch):
+        """ Map a list of `(key, value)` messages. Returns a `(key, values, error)`
+            tuple for each message. `error` is None if the message was mapped,
+            otherwise it is the exception raised while mapping it (a
+            MessageFiltered if the message was filtered out) and `values` is
+            None. Override this to map a whole batch at once.
+        """
+        results = []
+        for key, value in batch:
+            try:
+                key, values = self.message_to_values(key, value)
+                results.append((key, values, None))
+            except Exception as e:
+                results.append((key, None, e))
+        return results
+
 
 class JsonMap(BaseMap):
 
+    raw_json = True
+
     @property
     def upsert_constraint_name(self):
         return None
@@ -91,7 +240,8 @@ class JsonMap(BaseMap):
         return True
 
     def _check_value(self, value):
-        _ = payload_parse(value)
+        if not isinstance(value, RawJson):
+            _ = payload_parse(value)
         return True
 
     @property
@@ -105,10 +255,12 @@ class JsonMap(BaseMap):
 
     def message_to_values(self, key, value):
 
-        # Raises if invalid
-        value = payload_parse(value)
+        # Raises if invalid. RawJson was validated when it was unpacked.
+        if not isinstance(value, RawJson):
+            value = payload_parse(value)
 
-        self.check(key, value)
+        # The value was just validated, only check the key
+        self._check_key(key)
 
         values = {
             'sinked':  datetime.utcnow().replace(tzinfo=pytz.utc).isoformat(),
@@ -121,6 +273,8 @@ class JsonMap(BaseMap):
 
 class StringMap(BaseMap):
 
+    raw_json = True
+
     @property
     def upsert_constraint_name(self):
         return None
@@ -145,10 +299,15 @@ class StringMap(BaseMap):
         # Raises if invalid
         self.check(key, value)
 
+        if isinstance(value, RawJson):
+            payload = str.__str__(value)
+        else:
+            payload = json.dumps(value)
+
         values = {
             'sinked':  datetime.utcnow().replace(tzinfo=pytz.utc).isoformat(),
             'key':     key,
-            'payload': json.dumps(value),
+            'payload': payload,
         }
 
         return key, values
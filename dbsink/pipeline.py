@@ -0,0 +1,335 @@
+#!python
+# coding=utf-8
+import math
+import time
+import queue
+import threading
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from geoalchemy2.elements import WKBElement
+
+from dbsink import L, utils
+
+STOP = object()
+
+# The mapping and unpacking function of a map worker process
+_worker = {}
+
+
+def unpack_message(value, unpack=None, packing=None):
+    """ Unpack a message value. Raises a ValueError if it can not be unpacked. """
+    if value is not None and unpack:
+        try:
+            return unpack(value)
+        except BaseException:
+            raise ValueError(f'Error unpacking message using {packing}: {value}')
+    return value
+
+
+def log_mapping_error(value, error, counts=None):
+    if isinstance(error, utils.MessageFiltered):
+        L.debug(error)
+        if counts is not None:
+            counts['filtered'] += 1
+    else:
+        L.error(f'Skipping {value}, message could not be converted to a row - {repr(error)}')
+        if counts is not None:
+            counts['failed'] += 1
+
+
+def map_message(mapping, key, value, unpack=None, packing=None, counts=None):
+    """ Unpack and map a message into a `(key, values)` row. Returns None if
+        the message was filtered out or could not be mapped. If a `counts`
+        Counter is provided the rows, filtered and failed messages are counted.
+    """
+    try:
+        value = unpack_message(value, unpack=unpack, packing=packing)
+    except ValueError as e:
+        L.error(e)
+        if counts is not None:
+            counts['failed'] += 1
+        return None
+
+    # Custom conversion function for the table
+    try:
+        mapped = mapping.message_to_values(key, value)
+    except BaseException as e:
+        log_mapping_error(value, e, counts=counts)
+        return None
+
+    if counts is not None:
+        counts['rows'] += 1
+    return mapped
+
+
+def map_messages(mapping, messages, unpack=None, packing=None, counts=None):
+    """ Map a list of `(key, value)` messages into a list of row values using
+        the mapping's `messages_to_rows`
+    """
+    unpacked = []
+    for k, v in messages:
+        try:
+            unpacked.append((k, unpack_message(v, unpack=unpack, packing=packing)))
+        except ValueError as e:
+            L.error(e)
+            if counts is not None:
+                counts['failed'] += 1
+
+    rows = []
+    for (_, v), (_, values, error) in zip(unpacked, mapping.messages_to_rows(unpacked)):
+        if error is None:
+            rows.append(values)
+        else:
+            log_mapping_error(v, error, counts=counts)
+
+    if counts is not None:
+        counts['rows'] += len(rows)
+    return rows
+
+
+def _init_map_worker(lookup, topic, table, filters, packing, json_engine, raw_json, registry, level):
+    L.setLevel(level)
+    unpack, _ = utils.get_packing_funcs(packing, json_engine=json_engine, raw_json=raw_json, registry=registry)
+    _worker['mapping'] = utils.get_mappings()[lookup](topic, table=table, filters=filters)
+    _worker['unpack'] = unpack
+    _worker['packing'] = packing
+
+
+def _picklable(values):
+    # WKBElements created from shapely geometries wrap a memoryview
+    for k, v in values.items():
+        if isinstance(v, WKBElement) and isinstance(v.data, memoryview):
+            values[k] = WKBElement(bytes(v.data), srid=v.srid, extended=v.extended)
+    return values
+
+
+def _map_chunk(messages):
+    counts = Counter()
+    rows = map_messages(
+        _worker['mapping'],
+        messages,
+        unpack=_worker['unpack'],
+        packing=_worker['packing'],
+        counts=counts
+    )
+    return [ _picklable(r) for r in rows ], counts
+
+
+class MapWorkers:
+    """ Maps batches of messages on a pool of processes. Each process builds
+        its own instance of the `lookup` mapping from the `dbsink.maps` entry
+        point. Batches are split into one chunk per process and the mapped
+        rows are returned in the order the messages were received. Avro
+        messages are decoded on the processes if a `registry` is provided.
+        The rows, filtered and failed messages are counted in `counts`.
+    """
+
+    def __init__(self, workers, lookup, topic, table, filters, packing, json_engine='simplejson', raw_json=False, registry=None):
+        self.workers = workers
+        self.counts = Counter()
+        # Processes are started with `spawn`, forking a process running the
+        # pipeline, consumer and database pool threads is not safe
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_map_worker,
+            initargs=(lookup, topic, table, filters, packing, json_engine, raw_json, registry, L.level)
+        )
+
+    def __call__(self, messages):
+        size = math.ceil(len(messages) / self.workers)
+        chunks = [ messages[i:i + size] for i in range(0, len(messages), size) ]
+
+        mapped = []
+        for rows, counts in self.executor.map(_map_chunk, chunks):
+            mapped += rows
+            self.counts.update(counts)
+        return mapped
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class PipelineError(Exception):
+    pass
+
+
+class Pipeline:
+    """ Overlaps consuming, mapping and writing messages.
+
+        Messages are collected into batches on the calling (consumer) thread
+        with `put`. Each batch is mapped into rows on a mapping thread and
+        written to the database by one of `writer_threads` writer threads.
+        The stages are connected by queues holding at most `queue_size`
+        batches, so a slow database applies backpressure all the way back to
+        the consumer.
+
+        If `checkpoint` is provided it is called on the consumer thread when
+        a batch is closed and the value it returns is passed to `on_commit`
+        once that batch, and every batch before it, has been written.
+
+        If a `sizer` is provided it replaces `batch_size` and `batch_ms` each
+        time a batch is handed off, using the latency of the last write and
+        the number of batches queued up behind it.
+    """
+
+    def __init__(self, map_batch, writer, batch_size=1, batch_ms=0, writer_threads=1, queue_size=4, checkpoint=None, on_commit=None, sizer=None):
+        self.map_batch = map_batch
+        self.writer = writer
+        self.batch_size = max(batch_size, 1)
+        self.batch_ms = batch_ms
+        self.checkpoint = checkpoint
+        self.on_commit = on_commit
+        self.sizer = sizer
+        if sizer is not None:
+            self.batch_size, self.batch_ms = sizer.size, sizer.ms
+        # Seconds taken by the last write
+        self.latency = 0
+
+        self.messages = []
+        self.started = None
+        self.sequence = 0
+
+        # Batches must be committed in the order they were consumed
+        self.committed = 0
+        self.done = {}
+        self.commit_lock = threading.Lock()
+
+        self.error = None
+        self.map_queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.write_queue = queue.Queue(maxsize=max(queue_size, 1))
+
+        self.threads = [
+            threading.Thread(target=self._run, args=(self._map_stage,), name='dbsink-mapper', daemon=True)
+        ]
+        for i in range(max(writer_threads, 1)):
+            self.threads.append(
+                threading.Thread(target=self._run, args=(self._write_stage,), name=f'dbsink-writer-{i}', daemon=True)
+            )
+        for t in self.threads:
+            t.start()
+
+    @property
+    def writer_threads(self):
+        return len(self.threads) - 1
+
+    @property
+    def lingered(self):
+        if not self.messages or not self.batch_ms:
+            return False
+        return (time.monotonic() - self.started) * 1000 >= self.batch_ms
+
+    def put(self, key, value):
+        """ Add a message to the current batch, handing the batch off to be
+            mapped and written once it is full or has lingered too long.
+        """
+        if not self.messages:
+            self.started = time.monotonic()
+        self.messages.append((key, value))
+
+        if len(self.messages) >= self.batch_size or self.lingered:
+            self.submit()
+
+    def tick(self):
+        """ Hand off the current batch if it has lingered too long. Call this
+            periodically when no messages are being received.
+        """
+        if self.lingered:
+            self.submit()
+
+    def submit(self):
+        if not self.messages:
+            return
+
+        token = self.checkpoint() if self.checkpoint is not None else None
+        batch = (self.sequence, self.messages, token)
+        full = len(self.messages) >= self.batch_size
+        backlog = self.map_queue.qsize() + self.write_queue.qsize()
+        self.sequence += 1
+        self.messages = []
+        self.started = None
+        self._put(self.map_queue, batch)
+
+        if self.sizer is not None:
+            self.batch_size, self.batch_ms = self.sizer.update(self.latency, full, backlog=backlog)
+
+    def close(self):
+        """ Write any remaining messages and wait for the stages to finish """
+        try:
+            if self.error is None:
+                self.submit()
+        finally:
+            self._put(self.map_queue, STOP, check=False)
+            for t in self.threads:
+                t.join()
+
+        if self.error is not None:
+            raise PipelineError('Pipeline stopped') from self.error
+
+    def _put(self, q, item, check=True):
+        # Block while the queue is full, but stop waiting if a stage has died
+        while True:
+            if check is True and self.error is not None:
+                raise PipelineError('Pipeline stopped') from self.error
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if self.error is not None and check is False:
+                    return
+
+    def _get(self, q):
+        # Block until an item is available, but stop waiting if a stage has died
+        while self.error is None:
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return STOP
+
+    def _run(self, stage):
+        try:
+            stage()
+        except BaseException as e:
+            L.error(f'{threading.current_thread().name} stopped - {repr(e)}')
+            self.error = e
+
+    def _map_stage(self):
+        try:
+            while True:
+                batch = self._get(self.map_queue)
+                if batch is STOP:
+                    break
+
+                sequence, messages, token = batch
+                rows = self.map_batch(messages)
+                self._put(self.write_queue, (sequence, rows, token))
+        finally:
+            for _ in range(self.writer_threads):
+                self._put(self.write_queue, STOP, check=False)
+
+    def _write_stage(self):
+        while True:
+            batch = self._get(self.write_queue)
+            if batch is STOP:
+                break
+
+            sequence, rows, token = batch
+            if rows and self.writer is not None:
+                start = time.monotonic()
+                self.writer.write(self.writer.dedupe(rows))
+                self.latency = time.monotonic() - start
+            self._completed(sequence, token)
+
+    def _completed(self, sequence, token):
+        with self.commit_lock:
+            self.done[sequence] = token
+            latest = None
+            while self.committed in self.done:
+                latest = self.done.pop(self.committed)
+                self.committed += 1
+
+            if latest is not None and self.on_commit is not None:
+                self.on_commit(latest)
@@ -2,64 +2,89 @@
 # coding=utf-8
 import re
 import ast
+import hashlib
 import simplejson as json
 from datetime import datetime
 from collections.abc import MutableMapping
 
 import pytz
+import numpy as np
 import sqlalchemy as sql
 from shapely.ops import unary_union
 from geoalchemy2.types import Geometry
 from geoalchemy2.shape import from_shape
-from shapely.geometry import shape, Point, box
-from dateutil.parser import parse as dtparse
+from geoalchemy2.elements import WKBElement
+from shapely.geometry import shape, box
 from sqlalchemy.dialects.postgresql import HSTORE, JSONB, DOUBLE_PRECISION
 
+from dbsink.geo import GeometryCache, point_element
 from dbsink.maps import BaseMap, payload_parse
-from dbsink.utils import MessageFiltered
+from dbsink.utils import MessageFiltered, parse_time
 from dbsink import L  # noqa
 
 xx = re.compile(r'[\x00-\x1f\\"]')
 ux = re.compile(r'[\\u[0-9A-Fa-f]]')
+# Strings without any of these characters are not changed by make_valid_string
+needs_cleaning = re.compile(r'[\x00-\x1f\\"\x80\]]')
+# The characters removed by `xx`
+INVALID_CHARS = dict.fromkeys([ *range(0x00, 0x20), ord('\\'), ord('"') ])
+
+# How strings decodable as JSON or Python literals start
+LITERAL_START = re.compile(r'''\s*(?:[{\[("'0-9+.-]|[bBrRuU]{1,2}['"])''')
+LITERAL_WORDS = {'true', 'false', 'null', 'NaN', 'Infinity', 'True', 'False', 'None'}
 
 
 WGS84_BBOX_180 = box(-180, -90, 180, 90)
 WGS84_BBOX_360 = box(0, -90, 360, 90)
 
 
-def flatten(d, parent_key='', sep='_'):
+def looks_like_literal(value):
+    """ If a string could be decoded by `expand_json_objects`. Only a cheap
+        check of how the string starts, it can return True for strings that
+        are not actually decodable.
+    """
+    return LITERAL_START.match(value) is not None or value.strip() in LITERAL_WORDS
+
+
+def flatten(d, parent_key='', sep='_', max_depth=None, max_width=None):
     # Adapted from:
     # https://stackoverflow.com/questions/6027558/flatten-nested-dictionaries-compressing-keys
     # to support nested lists and decoding of JSON objects that might be strings.
-    items = []
-    if isinstance(d, MutableMapping):
-        for k, v in d.items():
-            new_key = f'{parent_key}{sep}{k}' if parent_key else k
-            items.extend(
-                flatten(v, new_key, sep=sep
-            ).items())
-    elif isinstance(d, list):
-        # add the list object and its members as indexed items
-        items.append((parent_key, d))
-        for i, litem in enumerate(d):
-            new_key = f'{parent_key}{sep}{i}' if parent_key else i
-            items.extend(
-                flatten(litem, new_key, sep=sep
-            ).items())
-    elif isinstance(d, str):
-        # Try to expand it
-        try:
-            decoded = expand_json_objects(d)
-            items.extend(
-                flatten(decoded, parent_key, sep=sep
-            ).items())
-        except ValueError:
-            # Not decodable, just set the objects value
-            items.append((parent_key, d))
-    else:
-        items.append((parent_key, d))
+    # Containers below the top level that are nested deeper than `max_depth`
+    # or have more than `max_width` members are kept whole under their key.
+    items = {}
+    stack = [(parent_key, d, 0)]
+    while stack:
+        parent_key, d, depth = stack.pop()
+
+        if depth > 0 and isinstance(d, (MutableMapping, list)) and (
+            (max_depth is not None and depth > max_depth) or
+            (max_width is not None and len(d) > max_width)
+        ):
+            items[parent_key] = d
+        elif isinstance(d, MutableMapping):
+            stack.extend(reversed([
+                (f'{parent_key}{sep}{k}' if parent_key else k, v, depth + 1)
+                for k, v in d.items()
+            ]))
+        elif isinstance(d, list):
+            # add the list object and its members as indexed items
+            items[parent_key] = d
+            stack.extend(reversed([
+                (f'{parent_key}{sep}{i}' if parent_key else i, litem, depth + 1)
+                for i, litem in enumerate(d)
+            ]))
+        elif isinstance(d, str) and looks_like_literal(d):
+            # Try to expand it
+            try:
+                stack.append((parent_key, expand_json_objects(d), depth))
+            except ValueError:
+                # Not decodable, just set the objects value
+                items[parent_key] = d
+        else:
+            items[parent_key] = d
 
-    return dict(items)
+    return items
 
 
 def expand_json_objects(str_value):
@@ -87,28 +112,39 @@ def get_point_location_quality(loc_geom, inprecise_location=False, disallow_lon=
         4 - Bad
         9 - Missing Data
     """
+    return get_location_quality(
+        loc_geom.x,
+        loc_geom.y,
+        inprecise_location=inprecise_location,
+        disallow_lon=disallow_lon,
+        disallow_lat=disallow_lat
+    )
+
+
+def get_location_quality(x, y, inprecise_location=False, disallow_lon=None, disallow_lat=None):
+    """ The QARTOD location flag of a longitude (x) and latitude (y), see
+        get_point_location_quality
+    """
 
     # Avoid locations that are both small decimal numbers.
-    if -1 < loc_geom.x < 1 and -1 < loc_geom.y < 1:
+    if -1 < x < 1 and -1 < y < 1:
         return 4
 
     # Avoid "null island" locations
-    if loc_geom.x == 0 or loc_geom.y == 0:
+    if x == 0 or y == 0:
         return 4
 
     # if we need to ignore certain X values
-    if isinstance(disallow_lon, list) and loc_geom.x in disallow_lon:
+    if isinstance(disallow_lon, list) and x in disallow_lon:
         return 4
 
     # if we need to ignore certain Y values
-    if isinstance(disallow_lat, list) and loc_geom.y in disallow_lat:
+    if isinstance(disallow_lat, list) and y in disallow_lat:
         return 4
 
-    # Make sure we have resonable coordinates
-    if not any([
-        loc_geom.within(WGS84_BBOX_180),
-        loc_geom.within(WGS84_BBOX_360)
-    ]):
+    # Make sure we have resonable coordinates, strictly within either
+    # WGS84_BBOX_180 or WGS84_BBOX_360
+    if not (-180 < x < 360 and -90 < y < 90):
         return 4
 
     # If using an inprecise location (ie. Iridium)
@@ -118,6 +154,26 @@ def get_point_location_quality(loc_geom, inprecise_location=False, disallow_lon=
     return 1
 
 
+def get_location_quality_array(x, y, inprecise_location=False, disallow_lon=None, disallow_lat=None):
+    """ Vectorized get_location_quality for arrays of longitudes (x) and
+        latitudes (y). Returns an array of QARTOD flags.
+    """
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+
+    bad = (-1 < x) & (x < 1) & (-1 < y) & (y < 1)
+    bad |= (x == 0) | (y == 0)
+    if isinstance(disallow_lon, list):
+        bad |= np.isin(x, disallow_lon)
+    if isinstance(disallow_lat, list):
+        bad |= np.isin(y, disallow_lat)
+    bad |= ~((-180 < x) & (x < 360) & (-90 < y) & (y < 90))
+
+    flags = np.full(np.broadcast(x, y).shape, 3 if inprecise_location is True else 1, dtype='int8')
+    flags[bad] = 4
+    return flags
+
+
 def apply_start_end_filter(message_time, starting, ending):
     if isinstance(starting, datetime) and message_time < starting:
         raise MessageFiltered(f'Filtering out message from {message_time} since it is before {starting}')
@@ -127,26 +183,156 @@ def apply_start_end_filter(message_time, starting, ending):
 
 def make_valid_string(obj):
     if isinstance(obj, str):
+        # Most strings need no cleaning at all
+        if needs_cleaning.search(obj) is None:
+            return obj
         try:
-            return ux.sub(
-                '',
-                xx.sub(
-                    '',
-                    obj
-                )
-            ).replace(
-                '\x80',
-                ''
-            ).replace(
-                '\x00',
-                ''
-            )
+            obj = obj.translate(INVALID_CHARS)
+            if ']' in obj:
+                obj = ux.sub('', obj)
+            return obj.replace('\x80', '')
         except BaseException:
             return obj
     else:
         return str(obj)
 
 
+def make_valid_values(values, skips=(), keep_none=True):
+    """ Apply `make_valid_string` to all of the values of a dict so they can
+        be stored as HSTORE values. None values are kept as NULLs unless
+        `keep_none` is False. Keys in `skips` are dropped.
+    """
+    if keep_none is False:
+        return { k: make_valid_string(x) for k, x in values.items() if k not in skips }
+    return {
+        k: make_valid_string(x) if x is not None else None
+        for k, x in values.items()
+        if k not in skips
+    }
+
+
+MISSING = object()
+
+
+def decode_value(value):
+    """ Decode a string holding a JSON object or Python literal, the same way
+        `flatten` does.
+    """
+    while isinstance(value, str) and looks_like_literal(value):
+        try:
+            value = expand_json_objects(value)
+        except ValueError:
+            break
+    return value
+
+
+class Field:
+    """ A value read from a message. Each of `paths` is a tuple of keys (or
+        list indexes) into the message, or a string of keys separated by
+        dots. The value at the first path found in the message is passed
+        through `transform`. If no path is found `default` is used, or a
+        KeyError is raised if there is no default. Strings holding JSON are
+        decoded along the way, like `flatten` does.
+    """
+
+    def __init__(self, *paths, transform=None, default=MISSING):
+        self.paths = [ tuple(p.split('.')) if isinstance(p, str) else tuple(p) for p in paths ]
+        self.transform = transform
+        self.default = default
+
+    def extractor(self):
+        """ A function that extracts this field from a message """
+        paths = self.paths
+        transform = self.transform
+        default = self.default
+
+        def extract(message):
+            for path in paths:
+                value = message
+                try:
+                    for step in path:
+                        value = decode_value(value)
+                        if isinstance(value, list):
+                            step = int(step)
+                        value = value[step]
+                except (KeyError, IndexError, TypeError, ValueError):
+                    continue
+
+                value = decode_value(value)
+                return transform(value) if transform is not None else value
+
+            if default is MISSING:
+                raise KeyError(f'None of {paths} were found in the message')
+            return default
+
+        return extract
+
+
+class FieldMap(BaseMap):
+    """ A mapping declared with rules instead of code.
+
+        `fields` maps column names to the Field each is read from. The
+        `time_field` column is used for the start and end date filters.
+        Datetimes are stored as ISO-8601 strings. The HSTORE `values` start
+        with every flattened field of the message if `flatten_values` is True
+        (minus the keys in `values_skips`) and are then updated with the
+        `values` rules. The sanitized message is stored as the `payload`.
+
+        The rules are compiled into extractors once, when the mapping is
+        created, and only the paths they list are read from each message.
+        Subclasses provide the `schema` and can override `finalize`.
+    """
+
+    fields = {}
+    time_field = 'time'
+    flatten_values = False
+    values = {}
+    values_skips = ()
+
+    def __init__(self, topic, **kwargs):
+        super().__init__(topic, **kwargs)
+        # Read the time first so filtered messages are skipped early
+        columns = sorted(self.fields, key=lambda c: c != self.time_field)
+        self.field_extractors = [ (c, self.fields[c].extractor()) for c in columns ]
+        self.value_extractors = [ (k, f.extractor()) for k, f in self.values.items() ]
+
+    def finalize(self, row, values):
+        """ Adjust the extracted row and values before they are cleaned """
+        pass
+
+    def message_to_values(self, key, value):
+        payload = payload_parse(value)
+
+        row = {}
+        for column, extract in self.field_extractors:
+            row[column] = extract(value)
+            if column == self.time_field:
+                apply_start_end_filter(
+                    row[column],
+                    self.filters.get('start_date'),
+                    self.filters.get('end_date')
+                )
+
+        values = flatten(value) if self.flatten_values is True else {}
+        for k, extract in self.value_extractors:
+            values[k] = extract(value)
+
+        self.finalize(row, values)
+
+        for column, v in row.items():
+            if isinstance(v, datetime):
+                row[column] = v.isoformat()
+
+        # All HSTORE values need to be strings
+        row['values'] = make_valid_values(values, skips=self.values_skips)
+        row['payload'] = payload
+
+        # Throw away non-column data
+        row = self.match_columns(row)
+        # Remove None to use the defaults defined in the table definition
+        return key, { k: v for k, v in row.items() if v is not None }
+
+
 class GenericFieldStatistic(BaseMap):
 
     @property
@@ -181,8 +367,8 @@ class GenericFieldStatistic(BaseMap):
         # Throw away non-column data
         value = self.match_columns(value)
 
-        value['starting'] = dtparse(value['starting']).replace(tzinfo=pytz.utc)
-        value['ending'] = dtparse(value['ending']).replace(tzinfo=pytz.utc)
+        value['starting'] = parse_time(value['starting'])
+        value['ending'] = parse_time(value['ending'])
 
         # Filter to make sure the time is represented in the filter window
         # First filter the `starting` between min and `end_date` filter
@@ -205,6 +391,11 @@ class GenericFieldStatistic(BaseMap):
 
 class GenericGeography(BaseMap):
 
+    def __init__(self, topic, **kwargs):
+        super().__init__(topic, **kwargs)
+        # The same regions are sent over and over
+        self.geometry_cache = GeometryCache(kwargs.get('geometry_cache_size', 1024))
+
     @property
     def schema(self):
         return [
@@ -231,13 +422,35 @@ class GenericGeography(BaseMap):
             )
         ]
 
+    def geometry_element(self, geometries):
+        """ The union of a list of GeoJSON geometries as a WKBElement. Unions
+            are cached by a hash of the canonical GeoJSON of the geometries.
+        """
+        # A single 2D point is its own union
+        if len(geometries) == 1 and geometries[0].get('type') == 'Point' and len(geometries[0]['coordinates']) == 2:
+            x, y = geometries[0]['coordinates']
+            return point_element(float(x), float(y))
+
+        canonical = json.dumps(geometries, sort_keys=True, separators=(',', ':'))
+        key = hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).digest()
+        element = self.geometry_cache.get(key)
+        if element is None:
+            merged = from_shape(unary_union([ shape(g) for g in geometries ]), srid=4326)
+            element = WKBElement(bytes(merged.data), srid=merged.srid, extended=merged.extended)
+            self.geometry_cache.put(key, element)
+
+        lookups = self.geometry_cache.hits + self.geometry_cache.misses
+        if lookups % 1000 == 0:
+            L.debug(self.geometry_cache)
+        return element
+
     def message_to_values(self, key, value):
         payload = payload_parse(value)
 
         tops = ['id', 'uid', 'gid', 'time', 'reftime', 'values', 'payload', 'geom', 'geojson']
         top_level = value.copy()
 
-        top_time = dtparse(top_level['time']).replace(tzinfo=pytz.utc)
+        top_time = parse_time(top_level['time'])
         apply_start_end_filter(
             top_time,
             self.filters.get('start_date'),
@@ -263,10 +476,7 @@ class GenericGeography(BaseMap):
 
         del top_level['geojson']
         # Merge any geometries into one
-        top_level['geom'] = from_shape(
-            unary_union([ shape(f['geometry']) for f in features ]),
-            srid=4326
-        )
+        top_level['geom'] = self.geometry_element([ f['geometry'] for f in features ])
 
         # Start values with the properties of each GeoJSON Feature.
         # There overwrite as they iterate. Finally they are overridden
@@ -288,13 +498,10 @@ class GenericGeography(BaseMap):
             top_level['reftime'] = top_level['time']
 
         # All HSTORE values need to be strings
-        values = {
-            k: make_valid_string(x) if x is not None else None
-            for k, x in values.items()
-        }
+        values = make_valid_values(values)
 
         top_level['time'] = top_time.isoformat()
-        top_level['reftime'] = dtparse(top_level['reftime']).replace(tzinfo=pytz.utc).isoformat()
+        top_level['reftime'] = parse_time(top_level['reftime']).isoformat()
         top_level['values'] = values
         top_level['payload'] = payload
 
@@ -344,7 +551,7 @@ class GenericFloat(BaseMap):
     def message_to_values(self, key, value):
         payload = payload_parse(value)
 
-        top_time = dtparse(value['time']).replace(tzinfo=pytz.utc)
+        top_time = parse_time(value['time'])
         apply_start_end_filter(
             top_time,
             self.filters.get('start_date'),
@@ -353,18 +560,17 @@ class GenericFloat(BaseMap):
 
         value['lat'] = float(value['lat'])
         value['lon'] = float(value['lon'])
-        pt = Point(value['lon'], value['lat'])
-        value['geom'] = from_shape(pt, srid=4326)
+        value['geom'] = point_element(value['lon'], value['lat'])
 
         if not value['values']:
             value['values'] = {}
-        value['values']['location_quality'] = get_point_location_quality(pt)
+        value['values']['location_quality'] = get_location_quality(value['lon'], value['lat'])
         # All HSTORE values need to be strings
-        value['values'] = { k: make_valid_string(x) for k, x in value['values'].items() }
+        value['values'] = make_valid_values(value['values'], keep_none=False)
 
         value['time'] = top_time.isoformat()
         if 'reftime' in value:
-            value['reftime'] = dtparse(value['reftime']).replace(tzinfo=pytz.utc).isoformat()
+            value['reftime'] = parse_time(value['reftime']).isoformat()
         else:
             value['reftime'] = value['time']
 
@@ -376,6 +582,28 @@ class GenericFloat(BaseMap):
         return key, { k: v for k, v in value.items() if v is not None }
 
 
+class FloatFieldMap(FieldMap, GenericFloat):
+    """ A FieldMap into the GenericFloat table. The `lat` and `lon` fields
+        are used for the point geometry and the location quality flag that
+        is added to the values.
+    """
+
+    inprecise_location = False
+    disallow_lon = None
+    disallow_lat = None
+
+    def finalize(self, row, values):
+        lon, lat = float(row['lon']), float(row['lat'])
+        row['geom'] = point_element(lon, lat)
+        values['location_quality'] = get_location_quality(
+            lon,
+            lat,
+            inprecise_location=self.inprecise_location,
+            disallow_lon=self.disallow_lon,
+            disallow_lat=self.disallow_lat
+        )
+
+
 class AreteData(GenericFloat):
 
     def message_to_values(self, key, value):
@@ -437,18 +665,15 @@ class AreteData(GenericFloat):
             'z':       None,
             'payload': payload
         }
-        pt = Point(top_level['lon'], top_level['lat'])
-        top_level['geom'] = from_shape(pt, srid=4326)
+        lon, lat = float(top_level['lon']), float(top_level['lat'])
+        top_level['geom'] = point_element(lon, lat)
 
         # Set additional values
-        values['location_quality'] = get_point_location_quality(pt, inprecise_location=inprecise_location)
+        values['location_quality'] = get_location_quality(lon, lat, inprecise_location=inprecise_location)
         values['mfr'] = 'arete'
 
         # All HSTORE values need to be strings
-        values = {
-            k: make_valid_string(x) if x is not None else None
-            for k, x in values.items()
-        }
+        values = make_valid_values(values)
 
         fullvalues = {
             **top_level,
@@ -463,122 +688,34 @@ class AreteData(GenericFloat):
         return key, { k: v for k, v in fullvalues.items() if v is not None }
 
 
-class NumurusData(GenericFloat):
+class NumurusData(FloatFieldMap):
 
-    def message_to_values(self, key, value):
-        payload = payload_parse(value)
+    fields = {
+        'uid':     Field('imei'),
+        'time':    Field('timestamp', transform=parse_time),
+        'reftime': Field('navsat_fix_time', transform=parse_time),
+        'lat':     Field('latitude'),
+        'lon':     Field('longitude'),
+    }
+    flatten_values = True
+    values = {
+        'mfr': Field(default='numurus'),
+    }
+    values_skips = (
+        # No easy way to represent this as a flat dict. We can write a db view to extract this
+        # data from the `payload` if required.
+        'data_segment_data_product_pipeline',
+        'data_segment_data_segment_data_product_pipeline'
+    )
 
-        values = flatten(value)
+    # Lat=91 and Lon=181 should be treated as bad location data
+    disallow_lon = [181]
+    disallow_lat = [91]
 
-        top_time = dtparse(values['timestamp']).replace(tzinfo=pytz.utc)
-        apply_start_end_filter(
-            top_time,
-            self.filters.get('start_date'),
-            self.filters.get('end_date')
-        )
-
-        top_level = {
-            'uid':     values['imei'],
-            'gid':     None,
-            'time':    top_time.isoformat(),
-            'reftime': dtparse(values['navsat_fix_time']).replace(tzinfo=pytz.utc).isoformat(),
-            'lat':     values['latitude'],
-            'lon':     values['longitude'],
-            'z':       None,
-            'payload': payload,
-        }
-        pt = Point(top_level['lon'], top_level['lat'])
-        top_level['geom'] = from_shape(pt, srid=4326)
-
-        skips = [
-            # No easy way to represent this as a flat dict. We can write a db view to extract this
-            # data from the `payload` if required.
-            'data_segment_data_product_pipeline',
-            'data_segment_data_segment_data_product_pipeline'
-        ]
-
-        # Set additional values
-        # Lat=91 and Lon=181 should be treated as bad location data
-        values['location_quality'] = get_point_location_quality(
-            pt,
-            disallow_lon=[181],
-            disallow_lat=[91]
-        )
-        values['mfr'] = 'numurus'
-
-        # All HSTORE values need to be strings
-        values = {
-            k: make_valid_string(x) if x is not None else None
-            for k, x in values.items()
-            if k not in skips
-        }
-
-        fullvalues = {
-            **top_level,
-            'values': {
-                **values
-            }
-        }
-
-        # Throw away non-column data
-        fullvalues = self.match_columns(fullvalues)
-        # Remove None to use the defaults defined in the table definition
-        return key, { k: v for k, v in fullvalues.items() if v is not None }
 
+class NumurusStatus(NumurusData):
 
-class NumurusStatus(GenericFloat):
-
-    def message_to_values(self, key, value):
-        payload = payload_parse(value)
-
-        values = flatten(value)
-
-        top_time = dtparse(values['timestamp']).replace(tzinfo=pytz.utc)
-        apply_start_end_filter(
-            top_time,
-            self.filters.get('start_date'),
-            self.filters.get('end_date')
-        )
-
-        top_level = {
-            'uid':     values['imei'],
-            'gid':     None,
-            'time':    top_time.isoformat(),
-            'reftime': dtparse(values['navsat_fix_time']).replace(tzinfo=pytz.utc).isoformat(),
-            'lat':     values['latitude'],
-            'lon':     values['longitude'],
-            'z':       None,
-            'payload': payload
-        }
-        pt = Point(top_level['lon'], top_level['lat'])
-        top_level['geom'] = from_shape(pt, srid=4326)
-
-        # Set additional values
-        # Lat=91 and Lon=181 should be treated as bad location data
-        values['location_quality'] = get_point_location_quality(
-            pt,
-            disallow_lon=[181],
-            disallow_lat=[91]
-        )
-        values['mfr'] = 'numurus'
-
-        # All HSTORE values need to be strings
-        values = {
-            k: make_valid_string(x) if x is not None else None
-            for k, x in values.items()
-        }
-
-        fullvalues = {
-            **top_level,
-            'values': {
-                **values
-            }
-        }
-
-        # Throw away non-column data
-        fullvalues = self.match_columns(fullvalues)
-        # Remove None to use the defaults defined in the table definition
-        return key, { k: v for k, v in fullvalues.items() if v is not None }
+    values_skips = ()
 
 
 class NwicFloatReports(GenericFloat):
@@ -629,17 +766,14 @@ class NwicFloatReports(GenericFloat):
             'z':       None,
             'payload': payload
         }
-        pt = Point(top_level['lon'], top_level['lat'])
-        top_level['geom'] = from_shape(pt, srid=4326)
+        lon, lat = float(top_level['lon']), float(top_level['lat'])
+        top_level['geom'] = point_element(lon, lat)
 
         # Set additional values
-        values['location_quality'] = get_point_location_quality(pt, inprecise_location=inprecise_location)
+        values['location_quality'] = get_location_quality(lon, lat, inprecise_location=inprecise_location)
 
         # All HSTORE values need to be strings
-        values = {
-            k: make_valid_string(x) if x is not None else None
-            for k, x in values.items()
-        }
+        values = make_valid_values(values)
 
         fullvalues = {
             **top_level,
@@ -667,7 +801,7 @@ class NwicFloatReportsSofar(GenericFloat):
 
         # Time - use float timestamp and fall back to Iridium
         reftime = datetime.utcnow().replace(microsecond=0)
-        timestamp = dtparse(values['timestamp']).replace(tzinfo=pytz.utc)
+        timestamp = parse_time(values['timestamp'])
 
         latdd = None
         londd = None
@@ -685,14 +819,11 @@ class NwicFloatReportsSofar(GenericFloat):
             'z':       None,
             'payload': payload
         }
-        pt = Point(top_level['lon'], top_level['lat'])
-        top_level['geom'] = from_shape(pt, srid=4326)
+        lon, lat = float(top_level['lon']), float(top_level['lat'])
+        top_level['geom'] = point_element(lon, lat)
 
         # All HSTORE values need to be strings
-        values = {
-            k: make_valid_string(x) if x is not None else None
-            for k, x in values.items()
-        }
+        values = make_valid_values(values)
 
         fullvalues = {
             **top_level,
@@ -1,25 +1,429 @@
 #!python
 # coding=utf-8
+import io
+import re
+import glob
+import gzip
+import json as stdjson
+import time
 import uuid
+import signal
+import struct
+import functools
+import itertools
+import pkg_resources
+import multiprocessing
+import urllib.request
 import simplejson as json
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import pytz
 import msgpack
+import fastavro
+from dateutil.parser import parse as dtparse
 
 from easyavro import EasyAvroConsumer, EasyConsumer
 
 from dbsink import L
+from dbsink.maps import sanitize, RawJson, raw_json_parse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class MessageFiltered(Exception):
     pass
 
 
-def get_kafka_consumer(brokers, topic, offset, packing, consumer=None, registry=None):
+# Dates and times datetime.fromisoformat parses the same way dateutil does
+ISO_8601 = re.compile(r'\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?(Z|[+-]\d{2}:\d{2})?')
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_time(value):
+    """ Parse a timestamp string into a UTC datetime. Any timezone in the
+        string is replaced (not converted) with UTC, the same as calling
+        `dateutil.parser.parse(value).replace(tzinfo=pytz.utc)`. ISO-8601
+        strings are parsed with `datetime.fromisoformat` and everything else
+        falls back to dateutil. Results are cached since the same reference
+        times show up in many messages.
+    """
+    m = ISO_8601.fullmatch(value)
+    if m is not None:
+        if m.group(1):
+            value = value[:m.start(1)]
+        try:
+            return datetime.fromisoformat(value).replace(tzinfo=pytz.utc)
+        except ValueError:
+            pass
+    return dtparse(value).replace(tzinfo=pytz.utc)
+
+
+def get_mappings():
+    return {
+        e.name: e.resolve() for e in pkg_resources.iter_entry_points('dbsink.maps')
+    }
+
+
+def _stdjson_dumps(value):
+    return stdjson.dumps(sanitize(value))
+
+
+def _simplejson_dumps(value):
+    return json.dumps(value, ignore_nan=True)
+
+
+def _orjson_loads(value):
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        # orjson does not accept NaN or Infinity
+        return stdjson.loads(value)
+
+
+def _orjson_dumps(value):
+    try:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    except TypeError:
+        # Types orjson does not serialize, like Decimal
+        return json.dumps(value, ignore_nan=True)
+
+
+def _orjson_raw_parse(value):
+    try:
+        orjson.loads(value)
+    except orjson.JSONDecodeError:
+        # Invalid, or contains NaN or Infinity values that need replacing
+        return raw_json_parse(value, loads=stdjson.loads)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value).decode('utf-8')
+    return RawJson(value)
+
+
+def _raw_json_passthrough(dumps):
+    @functools.wraps(dumps)
+    def wrapper(value):
+        if isinstance(value, RawJson):
+            return str.__str__(value)
+        return dumps(value)
+    return wrapper
+
+
+def get_raw_json_func(engine='simplejson'):
+    """ Function validating JSON text with one of the supported engines,
+        returning the text as RawJson. See `dbsink.maps.raw_json_parse`.
+    """
+    if engine == 'simplejson':
+        return raw_json_parse
+    elif engine == 'json':
+        return functools.partial(raw_json_parse, loads=stdjson.loads)
+    elif engine == 'orjson':
+        if orjson is None:
+            raise ValueError('The orjson JSON engine was requested but orjson is not installed')
+        return _orjson_raw_parse
+    raise ValueError(f'Unknown JSON engine: {engine}')
+
+
+def get_json_funcs(engine='simplejson'):
+    """ Functions to decode and encode JSON with one of the supported
+        engines: simplejson, json (the standard library) or orjson. Encoding
+        always writes NaN and Infinity values as null and RawJson values
+        are written unchanged.
+    """
+    if engine == 'simplejson':
+        return json.loads, _raw_json_passthrough(_simplejson_dumps)
+    elif engine == 'json':
+        return stdjson.loads, _raw_json_passthrough(_stdjson_dumps)
+    elif engine == 'orjson':
+        if orjson is None:
+            raise ValueError('The orjson JSON engine was requested but orjson is not installed')
+        return _orjson_loads, _raw_json_passthrough(_orjson_dumps)
+    raise ValueError(f'Unknown JSON engine: {engine}')
+
+
+# Confluent wire format: a zero magic byte and a 4 byte schema ID
+AVRO_MAGIC = 0
+AVRO_HEADER = struct.Struct('>bI')
+
+
+def is_registry_url(registry):
+    return registry.startswith(('http://', 'https://'))
+
+
+class SchemaRegistry:
+    """ Avro writer schemas by schema ID, fetched and parsed once. `registry`
+        is the URL of a schema registry or a local stand-in for one: either a
+        directory of `<id>.avsc` files, falling back to a `schema.avsc` file
+        for unknown IDs, or a single `.avsc` file used for every ID.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.schemas = {}
+
+    def __repr__(self):
+        return f'<SchemaRegistry {self.registry} schemas={sorted(self.schemas)}>'
+
+    def get(self, schema_id):
+        """ The parsed schema for a schema ID """
+        try:
+            return self.schemas[schema_id]
+        except KeyError:
+            schema = fastavro.parse_schema(self._load(schema_id))
+            self.schemas[schema_id] = schema
+            L.debug(f'Loaded avro schema {schema_id} from {self.registry}')
+            return schema
+
+    @property
+    def latest_id(self):
+        """ The schema ID used to encode values with a local registry: the
+            highest `<id>.avsc` in a directory, otherwise 1
+        """
+        path = Path(self.registry)
+        if path.is_dir():
+            ids = [ int(p.stem) for p in path.glob('*.avsc') if p.stem.isdigit() ]
+            if ids:
+                return max(ids)
+        return 1
+
+    def _load(self, schema_id):
+        if is_registry_url(self.registry):
+            url = f'{self.registry.rstrip("/")}/schemas/ids/{schema_id}'
+            with urllib.request.urlopen(url, timeout=10) as r:
+                return json.loads(json.load(r)['schema'])
+
+        path = Path(self.registry)
+        if path.is_dir():
+            candidates = [ path / f'{schema_id}.avsc', path / 'schema.avsc' ]
+            path = next(( p for p in candidates if p.is_file() ), None)
+            if path is None:
+                raise ValueError(f'No avro schema {schema_id} found in {self.registry}')
+        with open(path) as f:
+            return json.load(f)
+
+
+class AvroCodec:
+    """ Decodes and encodes avro values in the Confluent wire format with a
+        fastavro schemaless reader and writer, using the schemas of a
+        `SchemaRegistry` (or anything it accepts).
+    """
+
+    def __init__(self, registry):
+        if not isinstance(registry, SchemaRegistry):
+            registry = SchemaRegistry(registry)
+        self.registry = registry
+
+    def decode(self, value):
+        magic, schema_id = AVRO_HEADER.unpack_from(value)
+        if magic != AVRO_MAGIC:
+            raise ValueError(f'Unknown avro magic byte {magic}')
+        return fastavro.schemaless_reader(
+            io.BytesIO(memoryview(value)[AVRO_HEADER.size:]),
+            self.registry.get(schema_id)
+        )
+
+    def encode(self, value, schema_id=None):
+        if schema_id is None:
+            schema_id = self.registry.latest_id
+        buf = io.BytesIO()
+        buf.write(AVRO_HEADER.pack(AVRO_MAGIC, schema_id))
+        fastavro.schemaless_writer(buf, self.registry.get(schema_id), value)
+        return buf.getvalue()
+
+
+def get_packing_funcs(packing, json_engine='simplejson', raw_json=False, registry=None):
+    """ Functions to unpack and pack message values. Avro messages are
+        unpacked by the consumer so there are no functions for them unless a
+        `registry` is provided to decode them with an AvroCodec. With
+        `raw_json` JSON messages are only validated and unpacked as RawJson.
+        There are no functions for values that are already unpacked (None).
+    """
+    unpacking_func = None
+    packing_func = None
+    if packing == 'avro':
+        if registry:
+            codec = AvroCodec(registry)
+            unpacking_func = codec.decode
+            packing_func = codec.encode
+    elif packing == 'msgpack':
+        unpacking_func = lambda x: msgpack.loads(x, use_list=False, raw=False)  # noqa
+        packing_func = lambda x: msgpack.packb(x, use_bin_type=True)  # noqa
+    elif packing == 'json':
+        unpacking_func, packing_func = get_json_funcs(json_engine)
+        if raw_json is True:
+            unpacking_func = get_raw_json_func(json_engine)
+
+    return unpacking_func, packing_func
+
+
+def open_datafile(path):
+    """ Open a datafile as a binary stream, decompressing `.gz` and `.zst`
+        files as they are read.
+    """
+    path = Path(path)
+    if path.suffix == '.gz':
+        return gzip.open(path, 'rb')
+    elif path.suffix == '.zst':
+        if zstandard is None:
+            raise ValueError(f'Reading {path} requires the zstandard package')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+def _iter_json_array(f, buf, chunk_size):
+    # Decode one value at a time, reading more text whenever a value is
+    # incomplete. A number at the end of the text may have been cut short
+    # ("1.5e-3" read as "1.5e") so a few characters must follow each value.
+    decoder = json.JSONDecoder()
+    idx = 0
+    eof = False
+
+    def more():
+        nonlocal buf, idx, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf = buf[idx:] + chunk
+        idx = 0
+
+    def skip():
+        nonlocal idx
+        while True:
+            while idx < len(buf) and buf[idx].isspace():
+                idx += 1
+            if idx < len(buf) or eof:
+                return buf[idx:idx + 1]
+            more()
+
+    if skip() != '[':
+        raise ValueError('Expected a JSON array')
+    idx += 1
+    if skip() == ']':
+        return
+
+    while True:
+        skip()
+        try:
+            value, end = decoder.raw_decode(buf, idx)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            more()
+            continue
+
+        if len(buf) - end < 3 and not eof:
+            more()
+            continue
+        idx = end
+        yield value
+
+        sep = skip()
+        idx += 1
+        if sep == ']':
+            return
+        elif sep != ',':
+            raise ValueError(f'Expected "," or "]" in a JSON array, found {sep!r}')
+
+
+def iter_datafile(path, loads=json.loads, chunk_size=1 << 16):
+    """ Stream the decoded messages of a datafile without loading the whole
+        file. `.msgpack` files are a stream of msgpack values and `.avro`
+        files are avro container files. Other files are either a JSON array
+        or newline delimited JSON. Any of them can
+        be compressed with gzip (`.gz`) or zstandard (`.zst`).
+    """
+    path = Path(path)
+    name = path.stem if path.suffix in ('.gz', '.zst') else path.name
+
+    with open_datafile(path) as raw:
+        if name.endswith('.msgpack'):
+            yield from msgpack.Unpacker(raw, use_list=False, raw=False)
+            return
+        elif name.endswith('.avro'):
+            yield from fastavro.reader(raw)
+            return
+
+        f = io.TextIOWrapper(raw, encoding='utf-8')
+        buf = f.read(chunk_size)
+        while buf and not buf.strip():
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buf += chunk
+
+        if buf.lstrip()[:1] == '[':
+            yield from _iter_json_array(f, buf, chunk_size)
+            return
+
+        # Finish the partial last line before splitting the first chunk.
+        # Only on newlines, JSON strings can hold other line separators.
+        head = buf + f.readline()
+        for line in itertools.chain(io.StringIO(head), f):
+            if line.strip():
+                yield loads(line)
+
+
+def expand_datafiles(datafile):
+    """ The sorted list of files to load for a datafile argument: every file
+        in a directory, the files matching a glob pattern, or the path itself.
+    """
+    path = Path(datafile)
+    if path.is_dir():
+        return sorted( str(p) for p in path.iterdir() if p.is_file() and not p.name.startswith('.') )
+    elif re.search(r'[*?[]', datafile):
+        return sorted( p for p in glob.glob(datafile, recursive=True) if Path(p).is_file() )
+    return [datafile]
+
+
+def datafile_summary(name, counts, seconds):
+    """ A log line summarizing how a datafile was loaded """
+    rate = counts['rows'] / seconds if seconds > 0 else 0
+    return (
+        f'{name}: {counts["rows"]} rows in {seconds:.1f}s ({rate:.0f} rows/s), '
+        f'{counts["filtered"]} filtered, {counts["failed"]} failed'
+    )
+
+
+def load_datafiles(target, kwargs, datafiles, workers=1):
+    """ Run `target(datafile=path, **kwargs)` for each datafile on a pool of
+        `workers` processes, started with `spawn` so they do not share
+        database connections with the parent. Returns a dict of each
+        datafile's result, or the exception raised while loading it.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    with ProcessPoolExecutor(max_workers=max(workers, 1), mp_context=ctx) as pool:
+        futures = {
+            pool.submit(target, **{ **kwargs, 'datafile': d }): d for d in datafiles
+        }
+        for f in as_completed(futures):
+            d = futures[f]
+            try:
+                results[d] = f.result()
+            except BaseException as e:
+                L.error(f'Could not load {d} - {repr(e)}')
+                results[d] = e
+    return results
+
+
+def random_consumer_group(topic):
+    return f'dbsink-{topic}-{uuid.uuid4().hex[0:20]}'
+
+
+def get_kafka_consumer(brokers, topic, offset, packing, consumer=None, registry=None, kafka_conf=None, json_engine='simplejson', avro_decoder='easyavro'):
 
     # Generate a random consumer if one was not provided.
     # This guarentees a unique consumer ID for each run
     if not consumer:
-        consumer = f'dbsink-{topic}-{uuid.uuid4().hex[0:20]}'
+        consumer = random_consumer_group(topic)
         L.info(f'Setting consumer to {consumer}')
 
     consumer_kwargs = {
@@ -28,29 +432,128 @@ def get_kafka_consumer(brokers, topic, offset, packing, consumer=None, registry=
         'kafka_topic': topic,
         'offset': offset
     }
+    if kafka_conf:
+        consumer_kwargs['kafka_conf'] = kafka_conf
 
     # Setup the kafka consuimer
+    unpacking_func, packing_func = get_packing_funcs(packing, json_engine=json_engine)
     if packing == 'avro':
-        unpacking_func = None
-        packing_func = None
-        consumer_class = EasyAvroConsumer
         if not registry:
             raise ValueError('Avro packing requestd but no schema registry url was found!')
-        consumer_kwargs.update({
-            'schema_registry_url': registry,
-        })
-    elif packing == 'msgpack':
-        unpacking_func = lambda x: msgpack.loads(x, use_list=False, raw=False)  # noqa
-        packing_func = lambda x: msgpack.packb(x, use_bin_type=True)  # noqa
-        consumer_class = EasyConsumer
-    elif packing == 'json':
-        unpacking_func = json.loads
-        packing_func = lambda x: json.dumps(x, ignore_nan=True)  # noqa
+
+        if avro_decoder == 'fastavro' or not is_registry_url(registry):
+            # Decode the values ourselves, a local registry requires it
+            consumer_class = EasyConsumer
+            unpacking_func, packing_func = get_packing_funcs(packing, registry=registry)
+        else:
+            consumer_class = EasyAvroConsumer
+            consumer_kwargs.update({
+                'schema_registry_url': registry,
+            })
+    else:
         consumer_class = EasyConsumer
 
     return consumer_class, consumer_kwargs, unpacking_func, packing_func
 
 
+def consumer_positions(consumer):
+    """ The offsets of the next messages a consumer will return for each of
+        its assigned partitions.
+    """
+    c = consumer.consumer
+    return [ tp for tp in c.position(c.assignment()) if tp.offset >= 0 ]
+
+
+def commit_offsets(consumer, offsets=None):
+    """ Synchronously commit offsets for a consumer. With no `offsets` the
+        current positions are committed, so only call this once every message
+        the consumer has returned has been handled.
+    """
+    try:
+        if offsets is None:
+            consumer.consumer.commit(asynchronous=False)
+        elif offsets:
+            consumer.consumer.commit(offsets=offsets, asynchronous=False)
+    except BaseException as e:
+        # Nothing to commit or the commit failed. Either way the messages
+        # will be delivered again so there is no data loss.
+        L.warning(f'Could not commit consumer offsets - {repr(e)}')
+
+
+class OffsetCommitter:
+    """ Commits a consumer's current positions, but only if messages were
+        received since the last commit. Call `received` for every message
+        and call the committer once every one of them has been handled.
+    """
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.uncommitted = 0
+
+    def received(self):
+        self.uncommitted += 1
+
+    def __call__(self):
+        if self.uncommitted > 0:
+            commit_offsets(self.consumer)
+            self.uncommitted = 0
+
+
+def _stop(signum, frame):
+    raise SystemExit(0)
+
+
+def _run_process(target, kwargs):
+    # Exit through any `finally` blocks so buffered rows are flushed
+    signal.signal(signal.SIGTERM, _stop)
+    target(**kwargs)
+
+
+def supervise(target, kwargs=None, workers=1, restart_delay=5):
+    """ Run `target(**kwargs)` in `workers` processes, restarting any process
+        that exits with an error after `restart_delay` seconds. Returns once
+        every process has exited cleanly. Processes are started with `spawn`
+        so they do not share database or kafka connections with the parent.
+    """
+    ctx = multiprocessing.get_context('spawn')
+
+    def start(i):
+        p = ctx.Process(target=_run_process, args=(target, kwargs or {}), name=f'dbsink-worker-{i}')
+        p.start()
+        L.info(f'Started {p.name} (pid {p.pid})')
+        return p
+
+    processes = { i: start(i) for i in range(workers) }
+    restarts = {}
+
+    previous = signal.signal(signal.SIGTERM, _stop)
+    try:
+        while processes or restarts:
+            time.sleep(0.5)
+
+            for i, p in list(processes.items()):
+                if p.is_alive():
+                    continue
+                del processes[i]
+                if p.exitcode == 0:
+                    L.info(f'{p.name} finished')
+                else:
+                    L.error(f'{p.name} exited with code {p.exitcode}, restarting in {restart_delay}s')
+                    restarts[i] = time.monotonic() + restart_delay
+
+            for i, at in list(restarts.items()):
+                if time.monotonic() >= at:
+                    del restarts[i]
+                    processes[i] = start(i)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        for p in processes.values():
+            if p.is_alive():
+                p.terminate()
+        for p in processes.values():
+            p.join()
+
+
 def listen_unpack(brokers, topic, offset, packing, mapping, consumer=None, registry=None, on_receive=None, loop=False):
 
     consume_cls, consume_kw, unpack, _ = get_kafka_consumer(
@@ -0,0 +1,436 @@
+#!python
+# coding=utf-8
+import io
+import math
+import time
+import simplejson as json
+from datetime import date, datetime
+
+import sqlalchemy as sql
+from geoalchemy2.types import _GISType
+from geoalchemy2.elements import WKBElement, WKTElement
+from sqlalchemy.dialects.postgresql import insert, HSTORE, JSON, JSONB
+
+from dbsink import L
+from dbsink.geo import ewkb_hex
+from dbsink.maps import RawJson
+
+COPY_NULL = '\\N'
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\t': '\\t',
+})
+HSTORE_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '"': '\\"',
+})
+
+
+def hstore_text(value):
+    items = []
+    for k, v in value.items():
+        k = str(k).translate(HSTORE_ESCAPES)
+        if v is None:
+            items.append(f'"{k}"=>NULL')
+        else:
+            v = str(v).translate(HSTORE_ESCAPES)
+            items.append(f'"{k}"=>"{v}"')
+    return ', '.join(items)
+
+
+def json_text(value):
+    if isinstance(value, RawJson):
+        return str.__str__(value)
+    return json.dumps(value, ignore_nan=True)
+
+
+def geometry_text(value):
+    if isinstance(value, WKBElement):
+        return ewkb_hex(value)
+    elif isinstance(value, WKTElement):
+        if value.srid is not None and value.srid > 0 and not value.extended:
+            return f'SRID={value.srid};{value.data}'
+        return value.data
+    return str(value)
+
+
+def scalar_text(value):
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        elif math.isinf(value):
+            return 'Infinity' if value > 0 else '-Infinity'
+        return repr(value)
+    elif isinstance(value, (datetime, date)):
+        return value.isoformat()
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    return str(value)
+
+
+def copy_encoder(column, json_serializer=json_text):
+    """ Function encoding a python value into the text representation
+        PostgreSQL's COPY expects for this column's type.
+    """
+    if isinstance(column.type, (JSON, JSONB)):
+        return json_serializer
+    elif isinstance(column.type, HSTORE):
+        return hstore_text
+    elif isinstance(column.type, _GISType):
+        return geometry_text
+    return scalar_text
+
+
+def group_rows(rows):
+    """ Group rows by the set of columns they define """
+    groups = {}
+    for r in rows:
+        groups.setdefault(frozenset(r.keys()), []).append(r)
+    return groups
+
+
+def copy_line(values, encoders):
+    return '\t'.join(
+        COPY_NULL if v is None else enc(v).translate(COPY_ESCAPES)
+        for v, enc in zip(values, encoders)
+    ) + '\n'
+
+
+class BatchSizer:
+    """ Adapts the batch size and linger time between configured bounds.
+
+        Batches that fill up before they linger, or batches waiting behind
+        the one being written, mean messages are arriving faster than they
+        are written (catching up) so both limits are doubled. Otherwise we
+        are at the live edge of the topic and both are halved so rows are
+        written soon after they arrive. The batch size is also halved when
+        a flush takes longer than the maximum linger time.
+    """
+
+    def __init__(self, min_size, max_size, min_ms, max_ms):
+        self.max_size = max(max_size, 1)
+        self.min_size = min(max(min_size, 1), self.max_size)
+        # A linger time of 0 would never flush a partial batch
+        self.max_ms = max(max_ms, 1)
+        self.min_ms = min(max(min_ms, 1), self.max_ms)
+
+        self.size = self.min_size
+        self.ms = self.min_ms
+
+    def update(self, latency, full, backlog=0):
+        """ Adjust from the last flush, which took `latency` seconds. `full` is
+            whether the last batch reached the batch size and `backlog` the
+            number of batches waiting to be written. Returns the new
+            `(batch_size, batch_ms)`.
+        """
+        size, ms = self.size, self.ms
+        if full is True or backlog > 0:
+            size = min(size * 2, self.max_size)
+            ms = min(ms * 2, self.max_ms)
+        else:
+            size = max(size // 2, self.min_size)
+            ms = max(ms // 2, self.min_ms)
+
+        if latency * 1000 > self.max_ms:
+            size = max(size // 2, self.min_size)
+
+        if (size, ms) != (self.size, self.ms):
+            L.info(f'Batch size {size} rows, linger {ms}ms (last flush {latency * 1000:.0f}ms, backlog {backlog})')
+        self.size, self.ms = size, ms
+        return size, ms
+
+
+class BatchWriter:
+    """ Buffers mapped rows and writes them to a table in batches.
+
+        A batch is flushed when it holds `batch_size` rows or when the
+        oldest buffered row has waited longer than `batch_ms` milliseconds.
+        Each flush is written in a single transaction and `on_commit` (if
+        provided) is called once that transaction has committed.
+
+        Maps drop `None` values so the columns vary from row to row. Insert
+        statements are cached per set of columns and compiled once through
+        SQLAlchemy's `compiled_cache`. Rows are grouped by their columns and
+        each group is written with one executemany.
+
+        If a `sizer` is provided it replaces `batch_size` and `batch_ms`
+        after each flush.
+    """
+
+    def __init__(self, engine, sqltable, mapping, batch_size=1, batch_ms=0, on_commit=None, sizer=None):
+        self.engine = engine
+        self.sqltable = sqltable
+        self.mapping = mapping
+        self.batch_size = max(batch_size, 1)
+        self.batch_ms = batch_ms
+        self.on_commit = on_commit
+        self.sizer = sizer
+        if sizer is not None:
+            self.batch_size, self.batch_ms = sizer.size, sizer.ms
+        self.rows = []
+        self.started = None
+        self.statements = {}
+        self.compiled_cache = {}
+
+        self.defaults = {}
+        self.sequences = {}
+        for c in sqltable.columns:
+            if isinstance(c.default, sql.Sequence):
+                self.sequences[c.name] = c.default
+            elif c.default is not None and c.default.is_scalar:
+                self.defaults[c.name] = c.default.arg
+
+        # Columns of the constraint used to upsert rows
+        self.upsert_columns = mapping.upsert_columns
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def lingered(self):
+        if not self.rows or not self.batch_ms:
+            return False
+        return (time.monotonic() - self.started) * 1000 >= self.batch_ms
+
+    def add(self, key, values):
+        """ Buffer a row and flush if the batch is full or has lingered too long """
+        if not self.rows:
+            self.started = time.monotonic()
+        self.rows.append(values)
+
+        if len(self.rows) >= self.batch_size or self.lingered:
+            self.flush()
+
+    def tick(self):
+        """ Flush the buffered rows if they have lingered too long. Call this
+            periodically when no messages are being received. With nothing
+            buffered `on_commit` is called, since every message received so
+            far has been handled even if it did not produce a row.
+        """
+        if self.lingered:
+            self.flush()
+        elif not self.rows and self.on_commit is not None:
+            self.on_commit()
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        rows = self.rows
+        self.rows = []
+        self.started = None
+
+        start = time.monotonic()
+        self.write(self.dedupe(rows))
+        if self.sizer is not None:
+            full = len(rows) >= self.batch_size
+            self.batch_size, self.batch_ms = self.sizer.update(time.monotonic() - start, full)
+
+        if self.on_commit is not None:
+            self.on_commit()
+
+    def dedupe(self, rows):
+        """ Collapse rows sharing the same upsert key into one row, merging
+            the later rows over the earlier ones. PostgreSQL refuses to upsert
+            the same row twice in one statement. Merging gives the same result
+            as upserting the rows one after another, where columns a later row
+            does not define keep the earlier row's values. Rows with a NULL
+            key column never conflict so they are all kept.
+        """
+        if not self.upsert_columns:
+            return rows
+
+        unique = {}
+        for i, r in enumerate(rows):
+            key = tuple( r.get(c, self.defaults.get(c)) for c in self.upsert_columns )
+            if None in key:
+                key = i
+            else:
+                try:
+                    hash(key)
+                except TypeError:
+                    key = i
+            unique[key] = { **unique.pop(key, {}), **r }
+
+        if len(unique) != len(rows):
+            L.debug(f'Collapsed {len(rows) - len(unique)} duplicate rows')
+        return list(unique.values())
+
+    def statement(self, columns):
+        """ The (cached) insert or upsert statement for a set of columns """
+        columns = frozenset(columns)
+        if columns in self.statements:
+            return self.statements[columns]
+
+        insert_cmd = insert(self.sqltable)
+        if self.mapping.upsert_constraint_name is None:
+            stmt = insert_cmd, 'inserted'
+        else:
+            upsert_cmd = insert_cmd.on_conflict_do_update(
+                constraint=self.mapping.upsert_constraint_name,
+                set_={ c: insert_cmd.excluded[c] for c in sorted(columns) }
+            )
+            stmt = upsert_cmd, 'inserted/updated'
+
+        self.statements[columns] = stmt
+        return stmt
+
+    def connect(self):
+        """ A transaction on a connection that reuses compiled statements """
+        return self.engine.execution_options(compiled_cache=self.compiled_cache).begin()
+
+    def write(self, rows):
+        """ Write rows to the table in one transaction. Rows are grouped by the
+            columns they define so each group is a single executemany call.
+            If the batch fails the rows are retried one at a time so a single
+            bad row does not throw away the whole batch.
+        """
+        try:
+            with self.connect() as conn:
+                for columns, group in group_rows(rows).items():
+                    cmd, mode = self.statement(columns)
+                    conn.execute(cmd, group)
+                    L.debug(f'{mode} {len(group)} rows')
+        except sql.exc.OperationalError:
+            raise
+        except Exception as e:
+            if len(rows) == 1:
+                L.error(f'Skipping {rows[0]}, row could not be written - {repr(e)}')
+                return
+            L.warning(f'Batch of {len(rows)} rows could not be written, retrying one at a time - {repr(e)}')
+            for r in rows:
+                self.write([r])
+
+
+class CopyWriter(BatchWriter):
+    """ Writes batches with PostgreSQL's `COPY ... FROM STDIN`. This is only
+        valid for append-only mappings (no upsert constraint), see the
+        StagingCopyWriter for mappings that upsert.
+
+        COPY skips the defaults SQLAlchemy would normally apply, so scalar
+        column defaults are filled in here and values for columns backed
+        by a sequence are fetched for the whole batch up front. JSON columns
+        are encoded with `json_serializer`, which must write NaN and Infinity
+        values as null.
+    """
+
+    def __init__(self, engine, sqltable, mapping, json_serializer=json_text, **kwargs):
+        super().__init__(engine, sqltable, mapping, **kwargs)
+        self.encoders = { c.name: copy_encoder(c, json_serializer) for c in sqltable.columns }
+
+    def copy_columns(self, rows):
+        present = set(self.defaults)
+        for r in rows:
+            present.update(r.keys())
+        present.difference_update(self.sequences)
+        # Keep the table's column order
+        return [ c.name for c in self.sqltable.columns if c.name in present ]
+
+    def copy_rows(self, conn, tablename, columns, rows):
+        """ COPY lists of values, ordered like `columns`, into `tablename` """
+        encoders = [ self.encoders[c] for c in columns ]
+        buf = io.StringIO()
+        for values in rows:
+            buf.write(copy_line(values, encoders))
+        buf.seek(0)
+
+        preparer = conn.dialect.identifier_preparer
+        columnnames = ', '.join( preparer.quote(c) for c in columns )
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(f'COPY {tablename} ({columnnames}) FROM STDIN', buf)
+        finally:
+            cursor.close()
+
+    def copy(self, conn, rows):
+        columns = self.copy_columns(rows)
+
+        sequence_values = {}
+        for name, seq in self.sequences.items():
+            fetch = sql.select([seq.next_value()]).select_from(
+                sql.func.generate_series(1, len(rows))
+            )
+            sequence_values[name] = [ x for x, in conn.execute(fetch) ]
+
+        values = []
+        for i, r in enumerate(rows):
+            values.append(
+                [ sequence_values[c][i] for c in sequence_values ] +
+                [ r.get(c, self.defaults.get(c)) for c in columns ]
+            )
+
+        tablename = conn.dialect.identifier_preparer.format_table(self.sqltable)
+        self.copy_rows(conn, tablename, list(sequence_values.keys()) + columns, values)
+
+    def write(self, rows):
+        try:
+            with self.connect() as conn:
+                self.copy(conn, rows)
+            L.debug(f'copied {len(rows)} rows')
+        except sql.exc.OperationalError:
+            raise
+        except Exception as e:
+            # Fall back to inserts, which will isolate any bad rows
+            L.warning(f'Batch of {len(rows)} rows could not be copied, falling back to inserts - {repr(e)}')
+            super().write(rows)
+
+
+class StagingCopyWriter(CopyWriter):
+    """ Upserts batches by COPYing them into a session-local temporary
+        staging table shaped like the target table and merging the staged
+        rows with one `INSERT ... SELECT ... ON CONFLICT DO UPDATE`.
+
+        Rows are staged and merged per column set, the same way the insert
+        path groups them, so columns a row does not define get the table
+        defaults on insert and are left alone on update.
+    """
+
+    @property
+    def stage_name(self):
+        return f'{self.mapping.table}_stage'.replace('-', '_').lower()
+
+    def stage(self, conn):
+        preparer = conn.dialect.identifier_preparer
+        stagename = preparer.quote(self.stage_name)
+        tablename = preparer.format_table(self.sqltable)
+        columns = ', '.join(
+            preparer.quote(c.name) for c in self.sqltable.columns if c.name not in self.sequences
+        )
+        conn.execute(
+            f'CREATE TEMPORARY TABLE IF NOT EXISTS {stagename} ON COMMIT DELETE ROWS '
+            f'AS SELECT {columns} FROM {tablename} WITH NO DATA'
+        )
+        return stagename
+
+    def merge_statement(self, columns):
+        """ The (cached) statement merging staged `columns` into the table """
+        key = ('merge', frozenset(columns))
+        if key in self.statements:
+            return self.statements[key]
+
+        columns = sorted(columns)
+        stage = sql.table(self.stage_name, *[ sql.column(c) for c in columns ])
+        merge_cmd = insert(self.sqltable).from_select(
+            columns,
+            sql.select([ stage.c[c] for c in columns ])
+        )
+        merge_cmd = merge_cmd.on_conflict_do_update(
+            constraint=self.mapping.upsert_constraint_name,
+            set_={ c: merge_cmd.excluded[c] for c in columns }
+        )
+        self.statements[key] = merge_cmd
+        return merge_cmd
+
+    def copy(self, conn, rows):
+        stagename = self.stage(conn)
+
+        for i, (columns, group) in enumerate(group_rows(rows).items()):
+            if i > 0:
+                conn.execute(f'TRUNCATE {stagename}')
+            columns = sorted(columns)
+            self.copy_rows(conn, stagename, columns, [ [ r[c] for c in columns ] for r in group ])
+            conn.execute(self.merge_statement(columns))
@@ -1,15 +1,18 @@
 #!python
 # coding=utf-8
 from pathlib import Path
+from collections import Counter
 import simplejson as json
 from datetime import datetime, timezone
 
 import pytest
+import sqlalchemy as sql
 from easyavro import EasyProducer
 from click.testing import CliRunner
 from dateutil.parser import parse as dtparse
+from sqlalchemy.dialects import postgresql
 
-from dbsink import maps, tables, listen, utils, L
+from dbsink import maps, tables, listen, utils, writer, pipeline, geo, L
 
 
 def test_listen_help():
@@ -76,6 +79,218 @@ def test_null_infinity():
     assert to_send[1][1]['payload']['bus_voltage'] is None
 
 
+def test_payload_parse():
+    from collections import namedtuple
+
+    Point = namedtuple('Point', 'x y')
+    payloads = [
+        {'a': float('nan'), 'b': [1, (2, float('inf'))], 'c': {'d': float('-inf')}},
+        {1: 'a', '1': 'b', 1.5: True, None: False},
+        Point(1, float('nan')),
+        [b'bytes', 'string', None],
+    ]
+    with open('./tests/null_infinity.json') as f:
+        payloads += json.load(f)
+
+    for p in payloads:
+        # Matches the result of serializing and parsing the payload
+        assert maps.payload_parse(p) == json.loads(json.dumps(p, ignore_nan=True))
+
+    p = {'a': [float('nan')]}
+    assert maps.payload_parse(p) == {'a': [None]}
+    assert p['a'][0] != p['a'][0]
+
+    with pytest.raises(ValueError):
+        maps.payload_parse({'a': {1, 2}})
+    with pytest.raises(ValueError):
+        maps.payload_parse({(1, 2): 'a'})
+
+
+def test_parse_time():
+    for value in [
+        '2020-01-01',
+        '2020-01-01T10:11',
+        '2020-01-01T10:11:12Z',
+        '2020-01-01 10:11:12.1234567+05:00',
+        '2019-08-06T18:00:00-04:00',
+        '20200101T101112',
+        'Jan 3 2020 10:00',
+    ]:
+        # The timezone is replaced, not converted
+        assert utils.parse_time(value) == dtparse(value).replace(tzinfo=timezone.utc)
+
+    assert utils.parse_time('2020-01-01T00:00:00Z') is utils.parse_time('2020-01-01T00:00:00Z')
+
+    with pytest.raises(ValueError):
+        utils.parse_time('2020-13-01')
+
+
+@pytest.mark.parametrize('engine', ['simplejson', 'json', 'orjson'])
+def test_json_engines(engine):
+    if engine == 'orjson':
+        pytest.importorskip('orjson')
+
+    loads, dumps = utils.get_json_funcs(engine)
+
+    decoded = loads('{"a": NaN, "b": [Infinity, -Infinity, 1.5], "c": "\u00e9"}')
+    assert decoded['a'] != decoded['a']
+    assert decoded['b'] == [float('inf'), float('-inf'), 1.5]
+    assert decoded['c'] == '\u00e9'
+
+    value = {'a': float('nan'), 'b': [float('inf'), 1.5, (1, 2)], 1: None}
+    assert json.loads(dumps(value)) == {'a': None, 'b': [None, 1.5, [1, 2]], '1': None}
+
+    unpack, pack = utils.get_packing_funcs('json', json_engine=engine)
+    assert unpack(pack(value)) == json.loads(dumps(value))
+
+    with pytest.raises(ValueError):
+        utils.get_json_funcs('nope')
+
+
+@pytest.mark.parametrize('engine', ['simplejson', 'json', 'orjson'])
+def test_raw_json(engine):
+    if engine == 'orjson':
+        pytest.importorskip('orjson')
+
+    unpack, _ = utils.get_packing_funcs('json', json_engine=engine, raw_json=True)
+    _, dumps = utils.get_json_funcs(engine)
+
+    # Valid text is passed through as-is
+    text = '{"b": 1,  "a": [1.5, "\u00e9"]}'
+    for value in [text, text.encode('utf-8')]:
+        raw = unpack(value)
+        assert isinstance(raw, maps.RawJson)
+        assert raw == text
+        assert dumps(raw) == text
+        assert writer.json_text(raw) == text
+
+    # Infinity and NaN values are replaced with null
+    raw = unpack(b'{"a": NaN, "b": [Infinity, -Infinity, 1]}')
+    assert json.loads(raw) == {'a': None, 'b': [None, None, 1]}
+
+    with pytest.raises(ValueError):
+        unpack(b'{"a": ')
+    with pytest.raises(ValueError):
+        unpack(b'\xff')
+
+    key, values = maps.JsonMap('topic').message_to_values('fake', raw)
+    assert values['payload'] is raw
+
+    key, values = maps.StringMap('topic').message_to_values('fake', unpack(text))
+    assert type(values['payload']) is str
+    assert values['payload'] == text
+
+    with open('./tests/null_infinity.json') as f:
+        messages = json.load(f)
+    for m in messages:
+        # Stores the same payload as decoding the message
+        raw = unpack(json.dumps(m))
+        assert json.loads(raw) == maps.JsonMap('topic').message_to_values('fake', m)[1]['payload']
+
+
+def test_avro_codec(tmp_path):
+    # The meta is a JSON string in the avro schema
+    with open('./tests/replayer.avro.json') as f:
+        messages = json.load(f)
+
+    # A single schema file is used for every schema ID
+    codec = utils.AvroCodec('schema.avsc')
+    for m in messages:
+        packed = codec.encode(m)
+        assert packed[:5] == b'\x00\x00\x00\x00\x01'
+        assert codec.decode(packed) == m
+    assert list(codec.registry.schemas) == [1]
+
+    # A directory of <id>.avsc files
+    schema = Path('schema.avsc').read_text()
+    (tmp_path / '7.avsc').write_text(schema)
+    (tmp_path / '12.avsc').write_text(schema)
+    unpack, pack = utils.get_packing_funcs('avro', registry=str(tmp_path))
+    packed = pack(messages[0])
+    assert packed[:5] == b'\x00\x00\x00\x00\x0c'
+    assert unpack(packed) == messages[0]
+    assert unpack(codec.encode(messages[0], schema_id=7)) == messages[0]
+
+    with pytest.raises(ValueError):
+        unpack(codec.encode(messages[0], schema_id=3))
+    with pytest.raises(ValueError):
+        unpack(b'\x01' + packed[1:])
+
+    # Decoded by the consumer
+    assert utils.get_packing_funcs('avro') == (None, None)
+
+    mapp = tables.GenericFloat('topic')
+    key, values = mapp.message_to_values('fake', unpack(packed))
+    assert values['time'] == '2019-05-07T19:57:56+00:00'
+
+
+def test_iter_datafile(tmp_path):
+    import gzip
+    import msgpack
+    import fastavro
+
+    with open('./tests/replayer.json') as f:
+        messages = json.load(f)
+
+    # JSON arrays are decoded incrementally
+    for chunk_size in [1, 3, 64, 1 << 16]:
+        assert list(utils.iter_datafile('./tests/replayer.json', chunk_size=chunk_size)) == messages
+
+    values = [123, 4.5e3, -1.5e-7, 'a]', {'x': [1, {}]}, None, True, 0, 1e300]
+    (tmp_path / 'values.json').write_text(' \n[' + ' , '.join( json.dumps(v) for v in values ) + '\n]')
+    for chunk_size in range(1, 10):
+        assert list(utils.iter_datafile(tmp_path / 'values.json', chunk_size=chunk_size)) == values
+
+    nan = list(utils.iter_datafile('./tests/null_infinity.json', chunk_size=7))
+    assert nan[0]['bus_voltage'] == float('inf')
+
+    (tmp_path / 'empty.json').write_text(' [ ] ')
+    assert list(utils.iter_datafile(tmp_path / 'empty.json', chunk_size=1)) == []
+
+    for bad in ['[1 2]', '[1,', '[1,]']:
+        (tmp_path / 'bad.json').write_text(bad)
+        with pytest.raises(ValueError):
+            list(utils.iter_datafile(tmp_path / 'bad.json', chunk_size=1))
+
+    # Newline delimited JSON
+    (tmp_path / 'messages.ndjson').write_text('\n'.join( json.dumps(m) for m in messages ) + '\n\n')
+    assert list(utils.iter_datafile(tmp_path / 'messages.ndjson', chunk_size=5)) == messages
+
+    # Line separators other than newlines are valid inside JSON strings
+    separators = [ {'a': f'x{c}y'} for c in '\u2028\u2029\x85\x0b\x0c\x1c\x1d\x1e' ]
+    (tmp_path / 'separators.ndjson').write_text(
+        '\n'.join( json.dumps(m, ensure_ascii=False) for m in separators ),
+        encoding='utf-8'
+    )
+    for chunk_size in [5, 1 << 16]:
+        assert list(utils.iter_datafile(tmp_path / 'separators.ndjson', chunk_size=chunk_size)) == separators
+
+    with gzip.open(tmp_path / 'messages.json.gz', 'wt') as f:
+        json.dump(messages, f)
+    assert list(utils.iter_datafile(tmp_path / 'messages.json.gz', chunk_size=5)) == messages
+
+    with gzip.open(tmp_path / 'messages.msgpack.gz', 'wb') as f:
+        for m in messages:
+            f.write(msgpack.packb(m, use_bin_type=True))
+    unpack, _ = utils.get_packing_funcs('msgpack')
+    assert list(utils.iter_datafile(tmp_path / 'messages.msgpack.gz')) == [ unpack(msgpack.packb(m)) for m in messages ]
+
+    with open('./tests/replayer.avro.json') as f:
+        records = json.load(f)
+    with open(tmp_path / 'messages.avro', 'wb') as f:
+        fastavro.writer(f, fastavro.parse_schema(json.loads(Path('schema.avsc').read_text())), records)
+    assert list(utils.iter_datafile(tmp_path / 'messages.avro')) == records
+
+
+def test_iter_datafile_zstandard(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+
+    with open('./tests/replayer.json', 'rb') as f:
+        (tmp_path / 'messages.json.zst').write_bytes(zstandard.ZstdCompressor().compress(f.read()))
+    with open('./tests/replayer.json') as f:
+        assert list(utils.iter_datafile(tmp_path / 'messages.json.zst', chunk_size=5)) == json.load(f)
+
+
 def test_health_and_status():
     mapp = tables.NwicFloatReports('foo')
 
@@ -280,6 +495,38 @@ def test_just_json():
     }
 
 
+def test_geography_geometry_cache():
+    from geoalchemy2.shape import from_shape
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+
+    mapp = tables.GenericGeography('topic', geometry_cache_size=2)
+
+    with open('./tests/scuttle-watch-regions.json') as f:
+        messages = json.load(f)
+
+    # Each region is sent twice in a row
+    for m in [ m for m in messages for _ in range(2) ]:
+        geojson = m['geojson']
+        if isinstance(geojson, str):
+            geojson = json.loads(geojson)
+        geometries = [ f['geometry'] for f in geojson['features'] ]
+        expected = from_shape(unary_union([ shape(g) for g in geometries ]), srid=4326)
+        _, values = mapp.message_to_values('fake', m)
+        assert bytes(values['geom'].data) == bytes(expected.data)
+        assert values['geom'].srid == 4326
+
+    assert len(mapp.geometry_cache) == 2
+    assert mapp.geometry_cache.hits + mapp.geometry_cache.misses == 12
+    assert mapp.geometry_cache.hits == 6
+
+    # Single points skip the union and the cache
+    point = {'type': 'Point', 'coordinates': [-145.5, 60.1]}
+    element = mapp.geometry_element([point])
+    assert bytes(element.data) == bytes(from_shape(shape(point), srid=4326).data)
+    assert mapp.geometry_cache.hits + mapp.geometry_cache.misses == 12
+
+
 def test_geography_driftworker_trajectories_individual():
     mapp = tables.GenericGeography('topic')
 
@@ -873,6 +1120,90 @@ def test_flatten():
             assert to_send[record][k] == v
 
 
+def test_flatten_limits():
+    m = {
+        'imei': '300234063904190',
+        'name': 'float-1',
+        'nested': '{"a": {"b": [1, 2]}}',
+        'wide': {'x': 1, 'y': 2, 'z': 3},
+    }
+    assert tables.flatten(m) == {
+        'imei': 300234063904190,
+        'name': 'float-1',
+        'nested_a_b': [1, 2],
+        'nested_a_b_0': 1,
+        'nested_a_b_1': 2,
+        'wide_x': 1,
+        'wide_y': 2,
+        'wide_z': 3,
+    }
+    assert tables.flatten(m, max_depth=1, max_width=2) == {
+        'imei': 300234063904190,
+        'name': 'float-1',
+        'nested_a': {'b': [1, 2]},
+        'wide': {'x': 1, 'y': 2, 'z': 3},
+    }
+
+    assert tables.looks_like_literal(' [1]')
+    assert tables.looks_like_literal("b'bytes'")
+    assert tables.looks_like_literal('NaN')
+    assert not tables.looks_like_literal('float-1')
+
+
+def test_make_valid_values():
+    assert tables.make_valid_string('float-1') == 'float-1'
+    assert tables.make_valid_string('a"b\\c\x00\n') == 'abc'
+    # The escape regex runs before \x80 characters are removed
+    assert tables.make_valid_string('1]') == ''
+    assert tables.make_valid_string('1\x80]') == '1]'
+    assert tables.make_valid_string(1.5) == '1.5'
+
+    values = {'a': 'x\ty', 'b': None, 'c': 2, 'd': 'skip'}
+    assert tables.make_valid_values(values) == {'a': 'xy', 'b': None, 'c': '2', 'd': 'skip'}
+    assert tables.make_valid_values(values, skips=('d',), keep_none=False) == {'a': 'xy', 'b': 'None', 'c': '2'}
+
+
+def test_location_quality():
+    from shapely.geometry import Point
+
+    lons = [-145.5, 0.5, 0, 200, 361, -180, 10, 10]
+    lats = [60.1, 0.5, 45, 45, 45, 45, 90, 45]
+    expected = [1, 4, 4, 1, 4, 4, 4, 4]
+
+    flags = [
+        tables.get_point_location_quality(Point(x, y), disallow_lat=[45.0])
+        for x, y in zip(lons[:-1], lats[:-1])
+    ]
+    assert flags == [1, 4, 4, 4, 4, 4, 4]
+
+    flags = [ tables.get_location_quality(x, y, disallow_lon=[10]) for x, y in zip(lons, lats) ]
+    assert flags == expected
+    assert tables.get_location_quality_array(lons, lats, disallow_lon=[10]).tolist() == expected
+
+    flags = tables.get_location_quality_array(lons, lats, inprecise_location=True)
+    assert flags.tolist() == [3, 4, 4, 3, 4, 4, 4, 3]
+
+
+def test_point_encoding():
+    from geoalchemy2.shape import from_shape
+    from shapely.geometry import Point
+    from shapely import wkb
+
+    lons = [-145.5, 0.0, 200, float('nan')]
+    lats = [60.1, 45, -89.99, 1]
+    for x, y in zip(lons, lats):
+        e = from_shape(Point(x, y), srid=4326)
+        p = geo.point_element(x, y)
+        assert bytes(p.data) == bytes(e.data)
+        assert (p.srid, p.extended) == (e.srid, e.extended)
+        assert geo.point_ewkb(x, y) == wkb.dumps(Point(x, y), srid=4326)
+        assert geo.ewkb_hex(p) == geo.point_ewkb(x, y).hex()
+
+    assert geo.points_wkb(lons, lats) == [ geo.point_wkb(x, y) for x, y in zip(lons, lats) ]
+    assert geo.points_ewkb(lons, lats) == [ geo.point_ewkb(x, y) for x, y in zip(lons, lats) ]
+    assert [ bytes(e.data) for e in geo.point_elements(lons, lats) ] == geo.points_wkb(lons, lats)
+
+
 def test_parsing_string_json_fields():
     mapp = tables.NwicFloatReports('foo')
 
@@ -1046,3 +1377,672 @@ def test_base64_images():
     assert to_send[0][1]['values']['image_One'] == "data:image/jpeg;base64,/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQH/2wBDAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQH/wAARCAAyADIDASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwD9OPgz/wAFSfg38Rbq20vxr4O8bfDzVLkTfvtMgt/iHodq0ZjEf2uXR10zxa6XJkKwvpngrUyhhnNylugt3uO7/bK8W2+ofCu2uLSRJ7TUGWS0uIwWSWK4aERuuVDAkMAyOFZHBRwrKyj09fAPhfRLy1fw94U8LeHgJV3f8I9pP9mGQuCvKefNyWJGPMcvk8DcFHzH+1Hf2fjn4hfDX4G6cHgMEM1/rqQ/uY5ft0tuLGzVQAkZtoxPNKF+YvcgSK3lqFDuwFKc68XFNpPdaW1T3+T8/I5n9jHSZNK8eOQjM91p+m3hQct5UMd1JvIDNtUpcFycABVJPAOP143FixxgAgHv6gduM4r8Sfiv8b779mT4jeKPiFouhJq3itNDvdD09f7TOl/2VPrb2U97fndYalJN+8gtmW3MMBkZdwuYmi2vD+w3+0z8b/il4vfwz4p8TSak9tb2txPeaiXuIbhLxb2SRILXYRaeX9lIys0gJlUlUxhvXy7H/VnyNXTvr1V9Nuu0Vt/me5mtKc8PFRV2rX+TX9fkft1uAyQVJHOCeCR2OCDgkYOCD1wc18ZfFv8AYr+A3xau7nV77wnF4Z8YzsWTxZ4TddOnG7rFqGiXqal4e1yBmRMRaxpd59nTzksntPtVyZvrOBpQqmQlmIO45H+12GeuamlUEqT26f5+uPyr2ef2lpd9dVa3XbvqfK89WHvUans6i+Gdr276XX5n45f8OhY/+Wf7QV0kf8CH4eqSqfwqSvjlFyq4Hyog44VRwCv2UyR3P5milb+tfLz8vx9b0sdnGn+2vp07cvl5fn5X+LNW+MOm6T4S8ReNNTDRWXhewmvZiiFZZJ1R2toLZGTNzPJKIx5UEc0iBkLIN6Bvyw8FftBeItM+LE/xc8ZWa+NNbLX7aVbC8j0uKxS8h8u2Md19h1DJsmYTRmS1uPN8tYtyB/NTV+J/7XPgTxd4L1XwvoWmXeoahrIhgV7ab4nzRW6pNHIJLib4nwWscaqUJCaY7u24lkLABvmrwydA1Mzw6z4y8O+Ep7ZbVbSDW4fEU02qmZZhKLBdD0HWII/sZiiFx/aU+n7vtdv9k+1bbkwfIH6HgsnjglKTSd0vevfR7aNvu0/v836X8T7L4h/H/TvEfiax0yPV/EUca3uvzQl1jWITSSIsUZP3VjUhBjOF28hTX1n/AMEuPClo158T9cubdBe6bF4U061ZvmeGSWPXXvvKOQQAY4Efpn5CScLjlvgP8TPB3wS8MfEq+1JPEPjq98Tx+GtK8O6Z4J8Ozas11dRnXxMbx72exm0y223kEjTNaXKmOC4aRUMUKz+w/wDBN+B7NPiLG0UsRvdTlcrMu1yIZlWPcMlS0e91O0kBi4B9NKaTmr9Gn87ojFUFOnJcraS0s76WenVn60KFwCBjr3PvT9zLyu4kf3SAfwJKj9RTd6kgZ5OccHtye1Or6ag3Kmm9dktLaJLsfCYhJVZpKyu9F6s81/4SmL/obo/+/XiX/wCayivKfEP/ACH9c/7DGp/+ls9FbGB/NDfeANWsPiGmoGxMGliW8CPuURSzoqNcR27bsP5QuI5ZACzL50e/bvUN6FqXw01TXHjvLAERJtLDy8lQjbsbiRk/I5wM46cGu3u7MSTQ3DYbZ5i7mJJyCd4PzcgkKDkk8dK2bjWtTsIIo7CcQQ4QOoGc+YrSDB91Lc988cGvz7C45V/ijy/8M/T8f1P2S+um7s+X0t8ujf3dG0/JtX8O+MEsbbQ9Fi+9KVvrhZkiu0t5REk0dm7kpEWESq7FQ23djIOD+pf/AAT68BeOtOtNXuvEHjG0nk8MpohuLS2sHK6hFrT6rHMt1cfbSbVoHso5Y8rqDTMxjaZdglf8yPGur3dppx1lpnM9tIhYRu6/Lkbm2gjPGTwCMDr1r70/Yv8AHetp4h8U+HLe7MFvqHgvVdS1JXUzZPhfw5r/AIltFEYeJhJI9nNaxSlysRuHmeK48sRN6dOUeda7eT7o8vFU+elLTV21T6K1tFfppt+TP2wjLbA5JKbWcNtIVkUOzOMjJUBSTjPT87xBHUV8i/Cr4hazeaR8O9L1cDUn1rXfFuk28nm+QbR7kfFpnuyfJkM5Q28KCEtFuBDecoj2t9hEg9Bj8c19NSqx5FeSvo9E3uk97b3bb3absz8+xWHqOvNxi2tOj009Pmt9GtT87fEWtj/hINd/4k+ov/xONT+eHUvGssL/AOmz/NFL/wAJgnmRt1STau9SG2rnAK1fEcI/4SHXv3C/8hnVOvjM5/4/p+v/ABdzr60Vp7Wn/N+Ev8jl9jPs/uf+XmvvPxosP+QBpP8AuD9IziuX1v8A5GXT/p4Y/XQviCT+Z5PvRRX5fgOn/b//ALafry3+UPziW9X5WzB5H2+yOD0yJ1IP1B5BrEl8V+KPDHiPU18N+JNf8PLe2enG8XQ9Y1HSVuzbLP8AZjdCwubcXH2f7RceR5u/yvPm8vb5r7iiveh8cf8AFH80Riv4M/l+ZS+Bfxb+KttYeDJ7b4m/EG3nRPiAUmg8Z+I4pUJj+KWSskepK65wM4I6Vx2v/tF/tBhFx8dvjJ1X/mp/jb/5eUUV78d4ekPyR8NV/wB4+Uv0PJ/+Fr/FL/opXj//AMLLxF/8saKKK3OA/9k="
     assert to_send[1][1]['values']['image_One'] == "data:image/jpeg;base64,/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQH/2wBDAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQH/wAARCAAyADIDASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwDy1/DngXxL4h8TahZ6zoPwm0G00O61Dwz4d1rUTqZ1PX4cCw8MW1+kOm/Zzq+ZTJ4h1CztNB0byEXVbm1+12zT8ZBqrXPkpEIwyrhTJGsyEZY52kgN14Pv78et+HfhJp/im9mPifxY3w/8O2wgtJvGF54Z13XvD9prWoNOuiaPq19osF0ujSawbXUDZXF0knm/Y7nyraYQzGL0LRv2bde8aeANZ8baR448B7dH0C91658OXERsNbhWzKiK01ZvDPgkaF4V+3F5fsWqeMtf0PQWNrdC41eEQyEgHiieNdZCSDVr836gIYGdiXTAYyCQvuL/AMITaQRhy2eAPcvC/wC2H498PeIdM8TXdl/wnWuyeApfh94lvvifqX/CZf8ACa+H7pkW9Gtr9g0rfuMKrbR/vfs2+Y+a+7B+V7rR7uJW8xtzFORkgZKsuRznGemQOB9KuDU4bjw7p2gyWJW6028uLtNRE/Gy4RY5rU2rQ/8ALQxW8zXCXAJMaRtCVQMAD610T46eHIfhm/gEQnwb/YA/tD4Zagtv4b8VHwL4kTeV1xdT8QeFrr4latnbbhrKz+Jmgl/LHn3NwVhEXnvivxN8M/Ff9n+KPD/g34aaKvjb7XffGL4MWOg+I9I8NWfiS3+zGz1zQPEPg/xr4S8R6MPEAu9SN9Z6ZdwBBptiZrq73RCPwE25keIlQViDO5f5gAAQOuST0x+pquupus0YEYUR5X5Ttzlt3DAYAbgnAPTnBOKDWjU9lNTte3S9uqfZ9ux+jX/CifAp5Pxt0iM947jwhqqTxn+5OkGpXcCTJ92RYbq5iVwwjuJkCyMV8JLrWFUHrgZ6dcc9Rn86KD0v7Tfb8PTy9f6Wv0RrWhSajcJBbJJHG86yx2rPiA3Gwok7oW274lL7DjKh3+bk10ifBr4mWNtHPB4cN1FdAyqyusTPuypZi7AFuACTk4AGSMV9S+Nv2ZviVoFx4oxoxuY/C09pG8kLjfcebKIZfL+Y7JIm3qVwxEiFCN4IHn+rfEPxH8MtI0X4f+JvhR4V8TwaTZfatO8X+NNV8W33ifXxqMNo98dW1Dw5rfhVo5IJoooYtEtjD4Y0QRynw54c8PHUtUW96DgPkjT/AId654va6XSbLzxZmD7WUHMIuDL5XysVJMgt5toG7lPm25zXnvjL4fa74B1678O+J9D13w1r9hsOoaF4m0w6Nrlg0wbYL3TRc3QtgxSQRFrhzKAzLt2siepQ+O9d8J+I9L8VeHL1NJ8QaQt1JYX4hVhCt35Nlqp8oSQrtu9Cn1XSmkDbbf8AtITlJDEI24X4hfETX/Fkdoms2ugA2ZmED6J4a0Hw2T9o8gyfav7B06w+3Bfs8Yg+3G4Frum+y+SbifzADyi+vRZlUXBLBgQOcZBxyCfr3HTr2x1cSEvjBOc/ifqfSoboPNJvJJzxz7Yx1PpUcff8P60AaHmv6/z/AMaKjooA/qO8WXXijwDoF7r+ueCvDd5KBELfw/qdoLzw7YLCoiCeFtMMg/4R9Z0KDUm86+F+ttpsIitxpokuvzJ/aW8XSfEDXk8SHRjpTESh7JbsXrIblYJFEt39mtPOFqd2l6av2WP+z/DWn6Bom64/ss3lz+7fxL+H8njq0+wM/lrKqwrI26UQtIVQSiHzoRL5Zy5iEkfmY2F1LEj8tfi7+zT8QNI8TXujLpD3MMRWVJoZPJdkdUKbSXXGRg5JHWsfb0v5jSlBVJqLlyp7u1+q2V137n5w+BLP4f6vN40HjK4SH7P4H1v+y9rBg8kxg+0bSCf3iCK2KclvnbGOa8mn8Li/6SqrAcNkdM56bh+hHvkV9Yt8O/BVkHkk0gTGbfCxid4UIwpdAvyEAhlzhQCRgjufFdX0BtFIOdwbHRhjk84AOAMsONv/ANbTnj3/AAf+R14rCRowhKDu5b677a7uy/U87+IXwN1XwqfDjaP4g0HxemuaBa65dLosOvWzaR9qB8q1n/tzStJN2ZtsjQzWKz+UI5bHVYtK1+z1XRdP8audKa1AEjoW6MQwKk5PKkMQRnjj0z0Oa+gp2kCMUkdCVJOxmUttBwCQw/vcE9K8f8YWzwssirtQAscHAIUopOATjbvQYA7n0NUcBynlj0H/AH0P8aKz/tD+p/P/AOtRQB/dMQN8ZwM7hzj3FWJP9XJ/uN/6CaKK+eW8vX9EaUv4sP8AEj8Of2rf+SkXH+4//oxq+B/H/WL6r/JKKK9E9PFfw6fp/wC20jyiuU8YAf8ACPX/AAP9dB/6DPRRXQcB4SvQfQfyoooroA//2Q=="
     assert to_send[2][1]['values']['image_One'] == "data:image/jpeg;base64,/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQH/2wBDAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQH/wAARCABkAGQDASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwD8r6hn/wBU3+fWovttv/z0H5r/APFVDPe2/ln5x+GD2PoTX5Pdd/6/po/Zm007a3T6Psv80ed+KOr/AEP8zXgmuf63/gTf+y17v4llSQybTnC5/MmvC9ajd5CVGQGb+aj+frWuHfLON9LJL8l+ZhiE/YyXXlj+DZzlOT7w/H+RpSjDt/n8cUifeH4/yNfXYOcZU0l0v2627N9mefgYSjVu9tf/AEr/AIP+di/B1T6n+ZrtY/8AVJ+P9K4uFSChI7+o9TXYRyoEUEngZ4x369SD2H618/xBF1Van713F9v5O/o/uPYe69H+LiQ6n/rU/wB5f/Zagv8A7kf0/wAKXUJkeSPDZO4H8sH+Q9PTOKq6lMjxIqnJIB/DKn9a58oTjRalo/e/FJfmQ7crV10+eiWnfZjUkQIoLoDjoWAP86bM6FDhlY88BgeqsM8Z9fzxWA8nzH5j29fQU3zB/eP61dPDe1qSm9Evx3ffpZP5dbmFf2ai4SnZy02TtZrzXZ97dfOWX75/H37mio6K6vYW6/j/AMA8x4KLbd9/U+hPt9z/AH/5/wCNNe8uHUqznB9M/wCP+frVHzU9f1H+NHmp6/qP8a8c93Ty/Dy/4H4eQ25mkmVmc5OP6/8A1z+f0rhJ41d2z1z16+nr7V2UkqbG57e3+NcjJ99vrQnZ6boWkm+qtH9f6/A5+ezXACJnkH72Oxz1Yeo+v4cZ3kMrDI29fQ9vrXVugfGe3+fUe9Z0luh2+2cdfb/ar0MNjJU0oPbXXV/Ldvz9TJQjTlzJW7WSS2s9E136+vk6CqFA+XBGcnJPUn3x0qy82UIJI9gW78dsDoaY4Axgev8ASomBIIH+ea3m/be9LX7vTzNLKST13bv1/wAui27FGa4lkbLNypyO3v8A5PX3qGWV3QhjkcfzFKykkkD9R6Ux0baePTuPUe9KEYwVoq3/AASmtGkuj0Kbu248+nYeg9qEdtw59ew9D7U1/vH8P5Cm1S028/x3PPxFGVRqUXqt1e1+2vzd79jXjlVUAyvGf4gO5NFYOT6n8zRRuZexrf1y/wCZ7N9ok9v/AB7/AOKpGnkYEZxnuCwPXPrVUSKTjP8AL+hNTiN2GQMg+4+nc141kvL5+n+S+49S0V0S/r/gfn3ZE08jEknGeCAWx0x0JNQ0pBHUUlNK2xSVtgqaCx+0KTuA25Ge578DcOmAOo68c1DWzpsSuuSxXOeQT6sAMbgD0J9s/nUfiXz/ACZMtvNtJet/PQwpNPdGIAB+jA/+zf57cVSe3J4PyZ78N6Hpu/zmu2mt1z93PQdT7kdx0ye3f2rKe1QFSE9f4j7f7VdkPhXz/NkPlvqmttF+PXbtY5v+yPM+fZ1/28dOOm/2qGfSBHGzFMf8D/L+I9/auswe6Y9uT/JiPyNNdSykBBk4678cEHsc1Qk3tdpbbvTbzt/T8reYTQSI7DYcDqeP8T2xzVbpXdzQKyuwjGduMnrjpyM+p/WuRltJ/NkwhI3HB/H8f1roOPGV5UmoqN27Xa76PTyfXTTduxneX7/p/wDXoq39nm/uH8j/AIUUHH7WT+z+X/yRpJrb71yBjPPX+uR+ldNDrtuwVd8e7GOSR049B7fz965CTSG2NhucHocH88j+dc0+n3kLtIHaTBGF37SRgHqQw7d8/wBK8aye6+/5f0/uPZWt72skvPt620Vn890tPXhd27gEOij6nnPPct2549fykDoejKfxrxYardeYgJICnkDvwe59O3PfvXYadq4URLMSBt4OeeSevzdMHsPT3ovt+vy/zRXM1ZPy/T1bav8ANdeh3lT28jI20Hhs5/AH0I9B/nNZ8FxHIowevP8AX1PrVgEHoaN1o/R/1/TKdpLyZuxyGVQx6/h6n0A9Kcy7sc4xVGD+P/gP/s1aSfeH4/yNdJk171r7tfj/AJEX2ZB0Qfof1OT+Zpj26hT8uOnI2gjBzwQPQVtIi7Rx69z6n3p2xfT9T/jQOolGLer20b3u0tdPT7kcfLbNvbEfB4+XGOgB4BwOc9uetVG09Tn9y2TjJx6e1dl5af3RTWiQggAD3xn+tdB506fM9rrS2vp5+X+RxR0iPPAGP8/7VFde1jkk9Px/+uaK2549/wAH/kT7L+7+P/BOdOkA8F/0/wDsqp3OgRGJjuAPJJx9T2PPP4Z57V6V/YM3qPzNMfQZtp5Az9T/AJ9fwryLef5eXl5f1pb1LS8vkmr7aXSXl6a+Z896loKQyhlTAxkZYcn5zzg57+3vXO3sU0UqMowMYPzehb0bPP074r3XVNFfdny15Uk5LHJO7pyRjPHHHv3rg7/SDkEKowSDneccn60f15Jaaf8ABt2vsh3tr5JK7dum+llfo17rOXi8QXNj5cbrncT6N1B5692zxxjryTXV2Guxzqu8qpOcZ4zyR0xkZxnn+Vcvf6NMzo/l4xwfmJ7HH8WO/wDP0rBu7K7jZNqlRweGyOpzxyegz0o7a/1p3v8AnfUOmndbXs9k9Xo3fu35q97e1W95FKoZWQ7u4PHGffjj6/hW/bTqzHAHbowOeo9PXj8a8JtNYntAituPJ5J3HBHfg9D64HA+tdxp+trMiF8rwT34yW988e2Qa6QetvwfW9102d9/RPTQ9TV02j5l/wC+h6/Wnbl/vL+Y/wAa49NRjbH71snHQnHIB9fQ/j26ip1vEBDF2YehJwcj3z9elA7u2ln6P0/4P4eZ1WQehBpazIZ1OQCWxjrn3PcVoK4fkf56+w9KCeSE224+9pdNtPt3RboooqueXf8ABf5B7Kn/AC/jL/M9Z+zQ/wBwfkP8KY9tEVICgZGMgDPPHp75q1RXJZdl/X/DL7i+VW7ffpt/kvuOTvdAjuvMYAD5TjDYIGCcckjuRk5/CvPr/wAPCOXGMYbh8qc55+7n9e+Pwr2oLgEZ6jHT6+/vWBeWatIr7cA/eOc5JJOcbvx6dsUbW9N38lb5/mSrq1933fZx0vvqtfXdM8jufDkW2PKFf+Bg9P8AgXbp/jXJar4diRVYDbx1GD/e6ru5/wAevFfQM+mEqmYh9M7vX0Y+4/XvXO3ujvvTbGF45znj73PLc56Uaf09enz7X/ELX7Xe/W+3e706dNr72PnGXw3Jv4iYY9GDA/iWyOnbBx15qO40u4tIGfy22r2zjk5PXce464OPwFfQY0QMATAmeepJ7k9cnvk/jQdCBHEMYPrjP6E10g1fdde8n29F1f8ASZ8tNqWrxXQRoJCBkn5FIAw3GQwJxjtke5rp7TWrvageM9DkMAOdx/2s/mMAcjoK9oufCdrtZjaxbiPVie/dm/DHJ9jXHzeGVR3xCAAThgze3bd3zQF9/k9babaK7VtuqT7aoradqjyBS4GVDE5GOMHB65+vPUenXrbSfz0DIN5JIO0E8gn0zjjHr+Fcg2nyRxEIhGVfb8x4PPfce59eK557rxPpTl9Lu/s+4nO5fNxk5PXjne3cZPPagLNu701snpf07Nb939zv7Dv/ANn9f/rUV4w3jzx3ESh14IRg4FpxyByD5y59Onaigq7fTR+fp/m/u8z7TooornGFQSgFkPcZx+IYfyoopPb5x/NEz+F/L80WljUqOPX37++aY1vFjO3kdD6ZwD0xRRTsnuh2XZfcUGtIASNv6+1AtoQchefz/Q8UUV0GN33f3sx9Qgjj4VcAgcfX9e3fIrkNRgjUgqMZxnGO2Pb3oooNOsPNO/noY7QRNnK9eD+WKoXljbeS7bOQMjt/Ifr196KKCmktklqttOqMU+HdLl+Z4CW6Z3duvPHvj2GB0FFFFBC6fL/3Gf/Z"
+
+
+def test_batch_writer_statements():
+    mapp = tables.GenericFloat('topic')
+    w = make_writer(writer.BatchWriter, mapp)
+
+    cmd, mode = w.statement(('uid', 'time', 'lat', 'lon'))
+    compiled = str(cmd.compile(dialect=postgresql.dialect()))
+    assert mode == 'inserted/updated'
+    assert 'ON CONFLICT ON CONSTRAINT topic_unique_constraint DO UPDATE' in compiled
+    assert 'lat = excluded.lat' in compiled
+
+    # Statements are cached by the set of columns
+    assert w.statement(['lon', 'lat', 'time', 'uid'])[0] is cmd
+    assert w.statement(['lon', 'lat', 'time'])[0] is not cmd
+
+    mapp = maps.JsonMap('topic')
+    w = make_writer(writer.BatchWriter, mapp)
+
+    cmd, mode = w.statement(('sinked', 'key', 'payload'))
+    compiled = str(cmd.compile(dialect=postgresql.dialect()))
+    assert mode == 'inserted'
+    assert 'ON CONFLICT' not in compiled
+
+
+@pytest.mark.integration
+def test_genericfloat_batch_integration():
+
+    runner = CliRunner()
+    result = runner.invoke(listen.setup, [
+        '--topic', 'genericfloat-batch-integration-test',
+        '--table', 'my-genericfloat-batch-table',
+        '--lookup', 'GenericFloat',
+        '--packing', 'json',
+        '--drop',
+        '--no-listen',
+        '--batch-size', '3',
+        '--datafile', str(Path('tests/replayer.json').resolve()),
+        '-v'
+    ])
+    L.info(result)
+    assert result.exit_code == 0
+
+
+@pytest.mark.integration
+def test_genericfloat_avro_integration():
+
+    runner = CliRunner()
+    result = runner.invoke(listen.setup, [
+        '--topic', 'genericfloat-avro-integration-test',
+        '--table', 'my-genericfloat-avro-table',
+        '--lookup', 'GenericFloat',
+        '--packing', 'avro',
+        '--registry', str(Path('schema.avsc').resolve()),
+        '--drop',
+        '--no-listen',
+        '--batch-size', '3',
+        '--datafile', str(Path('tests/replayer.avro.json').resolve()),
+        '-v'
+    ])
+    L.info(result)
+    assert result.exit_code == 0
+
+
+@pytest.mark.integration
+def test_genericfloat_parallel_datafiles_integration():
+
+    runner = CliRunner()
+    result = runner.invoke(listen.setup, [
+        '--topic', 'genericfloat-parallel-integration-test',
+        '--table', 'my-genericfloat-parallel-table',
+        '--lookup', 'GenericFloat',
+        '--packing', 'json',
+        '--drop',
+        '--no-listen',
+        '--workers', '2',
+        '--batch-size', '3',
+        '--datafile', str(Path('tests').resolve() / 'replayer*.json'),
+        '-v'
+    ])
+    L.info(result)
+    assert result.exit_code == 0
+
+
+@pytest.mark.integration
+def test_genericfloat_adaptive_integration():
+
+    runner = CliRunner()
+    result = runner.invoke(listen.setup, [
+        '--topic', 'genericfloat-adaptive-integration-test',
+        '--table', 'my-genericfloat-adaptive-table',
+        '--lookup', 'GenericFloat',
+        '--packing', 'json',
+        '--drop',
+        '--no-listen',
+        '--adaptive',
+        '--batch-size', '8',
+        '--datafile', str(Path('tests/replayer.json').resolve()),
+        '-v'
+    ])
+    L.info(result)
+    assert result.exit_code == 0
+
+
+@pytest.mark.integration
+def test_json_batch_integration():
+
+    runner = CliRunner()
+    result = runner.invoke(listen.setup, [
+        '--topic', 'json-batch-integration-test',
+        '--table', 'my-json-batch-table',
+        '--lookup', 'JsonMap',
+        '--packing', 'json',
+        '--drop',
+        '--no-listen',
+        '--batch-size', '4',
+        '--datafile', str(Path('tests/environmental.json').resolve()),
+        '-v'
+    ])
+    L.info(result)
+    assert result.exit_code == 0
+
+
+def test_copy_encoding():
+    from geoalchemy2.shape import from_shape
+    from shapely.geometry import Point
+    from shapely import wkb
+
+    pt = Point(-117.23662, 32.704426)
+    assert writer.ewkb_hex(from_shape(pt, srid=4326)) == wkb.dumps(pt, hex=True, srid=4326).lower()
+
+    assert writer.hstore_text({'a': '1', 'b': None, 'c"': 'x\\y'}) == '"a"=>"1", "b"=>NULL, "c\\""=>"x\\\\y"'
+
+    mapp = maps.JsonMap('topic')
+    w = make_writer(writer.CopyWriter, mapp)
+    assert list(w.sequences.keys()) == ['id']
+
+    rows = [
+        {'sinked': '2020-01-01T00:00:00+00:00', 'key': 'a\tb', 'payload': {'v': float('nan')}},
+        {'sinked': '2020-01-01T00:00:00+00:00', 'payload': {'v': 'line\nbreak'}},
+    ]
+    columns = w.copy_columns(rows)
+    assert columns == ['sinked', 'key', 'payload']
+
+    encoders = [ w.encoders[c] for c in columns ]
+    lines = [ writer.copy_line([ r.get(c, w.defaults.get(c)) for c in columns ], encoders) for r in rows ]
+    assert lines[0] == '2020-01-01T00:00:00+00:00\ta\\tb\t{"v": null}\n'
+    assert lines[1] == '2020-01-01T00:00:00+00:00\t\t{"v": "line\\\\nbreak"}\n'
+
+
+@pytest.mark.integration
+def test_json_copy_integration():
+
+    runner = CliRunner()
+    result = runner.invoke(listen.setup, [
+        '--topic', 'json-copy-integration-test',
+        '--table', 'my-json-copy-table',
+        '--lookup', 'JsonMap',
+        '--packing', 'json',
+        '--drop',
+        '--no-listen',
+        '--batch-size', '4',
+        '--load-mode', 'copy',
+        '--datafile', str(Path('tests/environmental.json').resolve()),
+        '-v'
+    ])
+    L.info(result)
+    assert result.exit_code == 0
+
+
+def test_staging_merge_statement():
+    mapp = tables.GenericFloat('topic')
+    w = make_writer(writer.StagingCopyWriter, mapp)
+    assert w.stage_name == 'topic_stage'
+
+    merge = w.merge_statement(['uid', 'time', 'lat', 'lon', 'values'])
+    assert w.merge_statement(['values', 'uid', 'time', 'lat', 'lon']) is merge
+    compiled = str(merge.compile(dialect=postgresql.dialect()))
+    assert 'FROM topic_stage ON CONFLICT ON CONSTRAINT topic_unique_constraint DO UPDATE' in compiled
+    assert "nextval('topic_id_seq')" in compiled
+    assert 'values = excluded.values' in compiled
+    assert 'payload = excluded.payload' not in compiled
+
+
+@pytest.mark.integration
+def test_genericfloat_copy_integration():
+
+    runner = CliRunner()
+    result = runner.invoke(listen.setup, [
+        '--topic', 'genericfloat-copy-integration-test',
+        '--table', 'my-genericfloat-copy-table',
+        '--lookup', 'GenericFloat',
+        '--packing', 'json',
+        '--drop',
+        '--no-listen',
+        '--batch-size', '3',
+        '--load-mode', 'copy',
+        '--datafile', str(Path('tests/replayer.json').resolve()),
+        '-v'
+    ])
+    L.info(result)
+    assert result.exit_code == 0
+
+
+def test_schema_views():
+    mapp = tables.GenericFloat('topic')
+    assert mapp.column_names is mapp.column_names
+    assert 'values' in mapp.column_names
+    assert isinstance(mapp.column_types['time'], sql.DateTime)
+    assert mapp.upsert_columns == ('uid', 'gid', 'time', 'lat', 'lon', 'z')
+    assert mapp.match_columns({'uid': 'a', 'nope': 1}) == {'uid': 'a'}
+
+    mapp = maps.JsonMap('topic')
+    assert mapp.column_names == {'id', 'sinked', 'key', 'payload'}
+    assert mapp.upsert_columns == ()
+
+
+def test_batch_writer_dedupe():
+    mapp = tables.GenericFloat('topic')
+    w = make_writer(writer.BatchWriter, mapp)
+    assert w.upsert_columns == ('uid', 'gid', 'time', 'lat', 'lon', 'z')
+
+    rows = [
+        {'uid': 'a', 'time': 't1', 'lat': 1.0, 'lon': 2.0, 'z': 0.0, 'values': {'v': '1'}},
+        {'uid': 'b', 'time': 't1', 'lat': 1.0, 'lon': 2.0, 'z': 0.0, 'values': {'v': '2'}},
+        {'uid': 'a', 'gid': '', 'time': 't1', 'lat': 1.0, 'lon': 2.0, 'z': 0.0, 'values': {'v': '3'}},
+        # Missing z is NULL, which never conflicts
+        {'uid': 'a', 'time': 't1', 'lat': 1.0, 'lon': 2.0, 'values': {'v': '4'}},
+        {'uid': 'a', 'time': 't1', 'lat': 1.0, 'lon': 2.0, 'values': {'v': '5'}},
+    ]
+    deduped = w.dedupe(rows)
+    assert [ r['values']['v'] for r in deduped ] == ['2', '3', '4', '5']
+
+    # Columns a later row does not define keep the earlier row's values
+    rows = [
+        {'uid': 'a', 'time': 't1', 'lat': 1.0, 'lon': 2.0, 'z': 0.0, 'reftime': 't0', 'values': {'v': '1'}},
+        {'uid': 'a', 'time': 't1', 'lat': 1.0, 'lon': 2.0, 'z': 0.0, 'values': {'v': '2'}},
+    ]
+    assert w.dedupe(rows) == [
+        {'uid': 'a', 'time': 't1', 'lat': 1.0, 'lon': 2.0, 'z': 0.0, 'reftime': 't0', 'values': {'v': '2'}},
+    ]
+    assert 'reftime' not in rows[1]
+
+    mapp = maps.JsonMap('topic')
+    w = make_writer(writer.BatchWriter, mapp)
+    assert w.upsert_columns == ()
+    assert w.dedupe(rows) == rows
+
+
+def test_batch_sizer():
+    sizer = writer.BatchSizer(10, 100, 50, 1000)
+    assert (sizer.size, sizer.ms) == (10, 50)
+
+    # Catching up, full batches grow to the upper bounds
+    assert sizer.update(0.01, True) == (20, 100)
+    assert sizer.update(0.01, False, backlog=2) == (40, 200)
+    for _ in range(5):
+        sizer.update(0.01, True)
+    assert (sizer.size, sizer.ms) == (100, 1000)
+
+    # Slow flushes shrink the batch size
+    assert sizer.update(2, True) == (50, 1000)
+
+    # At the live edge both shrink to the lower bounds
+    for _ in range(10):
+        sizer.update(0.01, False)
+    assert (sizer.size, sizer.ms) == (10, 50)
+
+    # A linger time of 0 would never flush a partial batch
+    sizer = writer.BatchSizer(1, 1, 0, 0)
+    assert (sizer.size, sizer.ms) == (1, 1)
+
+
+@pytest.mark.integration
+def test_arete_batch_integration():
+
+    runner = CliRunner()
+    result = runner.invoke(listen.setup, [
+        '--topic', 'arete-batch-test',
+        '--table', 'arete-batch-data',
+        '--lookup', 'AreteData',
+        '--packing', 'json',
+        '--drop',
+        '--no-listen',
+        '--batch-size', '50',
+        '--datafile', str(Path('tests/arete_data.json').resolve()),
+        '-v'
+    ])
+    L.info(result)
+    assert result.exit_code == 0
+
+
+def make_writer(cls, mapp):
+    """ A writer for a mapping's table that is not connected to a database """
+    sqltable = sql.Table(mapp.table, sql.MetaData(), *mapp.schema)
+    return cls(None, sqltable, mapp, batch_size=10)
+
+
+class FakeConsumer:
+    """ Stand-in for an EasyConsumer that records the offsets committed """
+
+    def __init__(self, positions=()):
+        self.consumer = self
+        self.positions = list(positions)
+        self.commits = []
+
+    def assignment(self):
+        return [ p.partition for p in self.positions ]
+
+    def position(self, partitions):
+        return self.positions
+
+    def commit(self, offsets=None, asynchronous=True):
+        assert asynchronous is False
+        self.commits.append(offsets)
+
+
+def test_commit_offsets():
+    from types import SimpleNamespace
+
+    c = FakeConsumer([
+        SimpleNamespace(partition=0, offset=10),
+        SimpleNamespace(partition=1, offset=-1001),
+    ])
+    positions = utils.consumer_positions(c)
+    assert [ p.partition for p in positions ] == [0]
+
+    utils.commit_offsets(c)
+    utils.commit_offsets(c, positions)
+    utils.commit_offsets(c, [])
+    assert c.commits == [None, positions]
+
+    def fail(**kwargs):
+        raise RuntimeError('No offset stored')
+    c.commit = fail
+    # Only logged, the messages will be delivered again
+    utils.commit_offsets(c)
+
+
+def test_writer_commits_offsets_after_writing():
+    c = FakeConsumer()
+    committer = utils.OffsetCommitter(c)
+    w = make_writer(writer.BatchWriter, tables.GenericFloat('topic'))
+    w.batch_size = 2
+    w.batch_ms = 0
+    w.on_commit = committer
+
+    written = []
+    w.write = written.append
+
+    # Offsets are committed once the batch is written
+    committer.received()
+    w.add('a', {'uid': 'a'})
+    assert c.commits == []
+    committer.received()
+    w.add('b', {'uid': 'b'})
+    assert len(written) == 1
+    assert c.commits == [None]
+
+    # Nothing is committed when the write fails
+    def fail(rows):
+        raise sql.exc.OperationalError('INSERT', {}, Exception('server closed the connection'))
+    w.write = fail
+    committer.received()
+    w.add('c', {'uid': 'c'})
+    committer.received()
+    with pytest.raises(sql.exc.OperationalError):
+        w.add('d', {'uid': 'd'})
+    assert c.commits == [None]
+
+    # Messages that did not produce rows are committed on an idle tick, once
+    c = FakeConsumer()
+    committer = utils.OffsetCommitter(c)
+    w.write = written.append
+    w.on_commit = committer
+    for _ in range(3):
+        committer.received()
+    w.tick()
+    w.tick()
+    assert c.commits == [None]
+
+    # Buffered rows are not committed until they are written
+    committer.received()
+    w.add('e', {'uid': 'e'})
+    w.tick()
+    assert c.commits == [None]
+    w.flush()
+    assert c.commits == [None, None]
+
+
+class ListWriter:
+    """ Stand-in for a BatchWriter that keeps rows in memory """
+
+    def __init__(self, fail_on=None):
+        self.rows = []
+        self.fail_on = fail_on
+
+    def dedupe(self, rows):
+        return rows
+
+    def write(self, rows):
+        if self.fail_on in rows:
+            raise ValueError('Could not write')
+        self.rows.extend(rows)
+
+
+def test_pipeline_commits_in_order():
+    w = ListWriter()
+    committed = []
+    checkpoints = iter(range(1000))
+
+    p = pipeline.Pipeline(
+        lambda messages: [ v * 2 for _, v in messages if v % 5 ],
+        w,
+        batch_size=7,
+        writer_threads=3,
+        queue_size=2,
+        checkpoint=lambda: next(checkpoints),
+        on_commit=committed.append
+    )
+    for i in range(100):
+        p.put(None, i)
+    p.close()
+
+    assert sorted(w.rows) == [ i * 2 for i in range(100) if i % 5 ]
+    # 15 batches, committed tokens only ever increase and end with the last batch
+    assert committed == sorted(committed)
+    assert committed[-1] == 14
+
+
+def test_pipeline_stops_on_writer_error():
+    w = ListWriter(fail_on=20)
+    committed = []
+    checkpoints = iter(range(1000))
+
+    p = pipeline.Pipeline(
+        lambda messages: [ v for _, v in messages ],
+        w,
+        batch_size=10,
+        writer_threads=1,
+        queue_size=1,
+        checkpoint=lambda: next(checkpoints),
+        on_commit=committed.append
+    )
+    with pytest.raises(pipeline.PipelineError):
+        for i in range(1000):
+            p.put(None, i)
+        p.close()
+    with pytest.raises(pipeline.PipelineError):
+        p.close()
+
+    # Nothing at or after the failed batch is committed
+    assert w.rows == list(range(20))
+    assert committed == [0, 1]
+
+
+@pytest.mark.integration
+def test_nwicfloat_pipeline_integration():
+
+    runner = CliRunner()
+    result = runner.invoke(listen.setup, [
+        '--topic', 'nwicfloat-pipeline-integration-test',
+        '--table', 'my-nwicfloat-pipeline-table',
+        '--lookup', 'NwicFloatReports',
+        '--packing', 'json',
+        '--drop',
+        '--no-listen',
+        '--batch-size', '25',
+        '--writer-threads', '2',
+        '--datafile', str(Path('tests/health_and_status.json').resolve()),
+        '-v'
+    ])
+    L.info(result)
+    assert result.exit_code == 0
+
+
+def test_messages_to_rows():
+    mapp = tables.GenericFloat('topic', filters={
+        'start_date': datetime(2019, 5, 8, tzinfo=timezone.utc)
+    })
+
+    with open('./tests/replayer.json') as f:
+        messages = json.load(f)
+
+    batch = [
+        ('a', messages[0]),
+        ('b', {'not': 'a float'}),
+    ]
+    results = mapp.messages_to_rows(batch)
+    assert [ r[0] for r in results ] == ['a', 'b']
+    assert results[0][1] is None
+    assert isinstance(results[0][2], utils.MessageFiltered)
+    assert results[1][1] is None
+    assert isinstance(results[1][2], KeyError)
+
+    with open('./tests/replayer.json') as f:
+        packed = [ (None, json.dumps(m)) for m in json.load(f) ]
+        messages = [ (None, json.loads(v)) for _, v in packed ]
+
+    mapp = tables.GenericFloat('topic')
+    results = mapp.messages_to_rows(messages)
+    assert len(results) == len(messages)
+    assert all( e is None for _, _, e in results )
+
+    unpack, _ = utils.get_packing_funcs('json')
+    counts = Counter()
+    rows = pipeline.map_messages(mapp, packed + [(None, '{')], unpack=unpack, packing='json', counts=counts)
+    assert [ r['values'] for r in rows ] == [ r[1]['values'] for r in results ]
+    assert counts == {'rows': 4, 'failed': 1}
+
+    mapp = tables.GenericFloat('topic', filters={
+        'start_date': datetime(2019, 5, 8, tzinfo=timezone.utc)
+    })
+    counts = Counter()
+    assert pipeline.map_message(mapp, None, packed[0][1], unpack=unpack, packing='json', counts=counts) is None
+    assert pipeline.map_message(mapp, None, '{"not": "a float"}', unpack=unpack, packing='json', counts=counts) is None
+    assert counts == {'filtered': 1, 'failed': 1}
+
+
+def test_field_map():
+
+    class MyFloat(tables.FloatFieldMap):
+        fields = {
+            'uid':     tables.Field('device.id', transform=str),
+            'time':    tables.Field('gps.time', 'time', transform=utils.parse_time),
+            'reftime': tables.Field('time', transform=utils.parse_time),
+            'lat':     tables.Field(('gps', 'position', 0)),
+            'lon':     tables.Field('gps.position.1'),
+        }
+        values = {
+            'battery': tables.Field('status.battery', default=None),
+            'mfr':     tables.Field(default='me'),
+        }
+
+    message = {
+        'device': {'id': 300234063904190},
+        'time': '2020-01-01T00:00:00Z',
+        'gps': '{"position": [60.1, -145.5]}',
+        'ignored': {'a': 1},
+    }
+    mapp = MyFloat('topic')
+    _, values = mapp.message_to_values('key', message)
+    geom = values.pop('geom')
+    assert bytes(geom.data) == geo.point_wkb(-145.5, 60.1)
+    assert values == {
+        'uid': '300234063904190',
+        'time': '2020-01-01T00:00:00+00:00',
+        'reftime': '2020-01-01T00:00:00+00:00',
+        'lat': 60.1,
+        'lon': -145.5,
+        'values': {'battery': None, 'mfr': 'me', 'location_quality': '1'},
+        'payload': message,
+    }
+
+    with pytest.raises(KeyError):
+        mapp.message_to_values('key', {'time': '2020-01-01T00:00:00Z'})
+
+    mapp = MyFloat('topic', filters={'end_date': datetime(2019, 1, 1, tzinfo=timezone.utc)})
+    with pytest.raises(utils.MessageFiltered):
+        mapp.message_to_values('key', message)
+
+
+def test_map_workers():
+    with open('./tests/arete_data.json') as f:
+        messages = [ (None, json.dumps(m)) for m in json.load(f) ]
+
+    unpack, _ = utils.get_packing_funcs('json')
+    mapp = tables.AreteData('topic')
+    expected = pipeline.map_messages(mapp, messages, unpack=unpack, packing='json')
+
+    workers = pipeline.MapWorkers(3, 'AreteData', 'topic', 'topic', {}, 'json')
+    try:
+        rows = workers(messages)
+    finally:
+        workers.close()
+
+    assert len(rows) == len(expected) == 137
+    for r, e in zip(rows, expected):
+        assert bytes(r.pop('geom').data) == bytes(e.pop('geom').data)
+        assert r == e
+
+
+@pytest.mark.integration
+def test_arete_map_workers_integration():
+
+    runner = CliRunner()
+    result = runner.invoke(listen.setup, [
+        '--topic', 'arete-map-workers-test',
+        '--table', 'arete-map-workers-data',
+        '--lookup', 'AreteData',
+        '--packing', 'json',
+        '--drop',
+        '--no-listen',
+        '--batch-size', '50',
+        '--map-workers', '2',
+        '--datafile', str(Path('tests/arete_data.json').resolve()),
+        '-v'
+    ])
+    L.info(result)
+    assert result.exit_code == 0
+
+
+def flaky_worker(path, fails):
+    # Append a line for each run and crash until `fails` runs have happened
+    with open(path, 'a') as f:
+        f.write('run\n')
+    with open(path) as f:
+        runs = len(f.readlines())
+    if runs <= fails:
+        raise SystemExit(1)
+
+
+def test_expand_datafiles(tmp_path):
+    for name in ['b.json', 'a.json', 'c.msgpack', '.hidden']:
+        (tmp_path / name).write_text('[]')
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'd.json').write_text('[]')
+
+    assert utils.expand_datafiles(str(tmp_path)) == [
+        str(tmp_path / 'a.json'),
+        str(tmp_path / 'b.json'),
+        str(tmp_path / 'c.msgpack'),
+    ]
+    assert utils.expand_datafiles(str(tmp_path / '*.json')) == [
+        str(tmp_path / 'a.json'),
+        str(tmp_path / 'b.json'),
+    ]
+    assert utils.expand_datafiles(str(tmp_path / '**' / '*.json')) == [
+        str(tmp_path / 'a.json'),
+        str(tmp_path / 'b.json'),
+        str(tmp_path / 'sub' / 'd.json'),
+    ]
+    assert utils.expand_datafiles(str(tmp_path / 'a.json')) == [str(tmp_path / 'a.json')]
+    assert utils.expand_datafiles(str(tmp_path / '*.nope')) == []
+
+
+def test_parallel_datafiles(tmp_path):
+    replayer = Path('tests/replayer.json').read_text()
+    for i in range(3):
+        (tmp_path / f'{i}.json').write_text(replayer)
+    (tmp_path / 'bad.json').write_text('[{"not": "a float"}]')
+
+    runner = CliRunner()
+    result = runner.invoke(listen.setup, [
+        '--topic', 'topic',
+        '--lookup', 'GenericFloat',
+        '--no-listen',
+        '--no-do-inserts',
+        '--workers', '2',
+        '--datafile', str(tmp_path),
+    ], standalone_mode=False)
+    assert result.exit_code == 0
+    assert result.return_value == {'rows': 12, 'failed': 1}
+
+    result = runner.invoke(listen.setup, [
+        '--topic', 'topic',
+        '--lookup', 'GenericFloat',
+        '--no-listen',
+        '--no-do-inserts',
+        '--datafile', str(tmp_path / '*.nope'),
+    ])
+    assert result.exit_code != 0
+
+
+def test_supervise_restarts_workers(tmp_path):
+    path = str(tmp_path / 'runs')
+    utils.supervise(flaky_worker, kwargs={'path': path, 'fails': 2}, workers=1, restart_delay=0)
+    with open(path) as f:
+        assert len(f.readlines()) == 3